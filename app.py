@@ -1,20 +1,61 @@
 from flask import Flask, render_template, request, jsonify, send_from_directory
 import os
+import time
 from pathlib import Path
-import llava_backend
 import vector_db
+import chat_sessions
+import http_cache
+import perf_profile
+import dedupe
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
+# Search-only workers reject uploads, indexing and chat, and never import torch/LLaVA
+app.config['READ_ONLY'] = os.environ.get('LLAVA_SEARCH_ONLY', '0') == '1'
+
+# Default for /api/search-images: 'vector', 'lexical' (BM25, no embedder) or 'hybrid'
+DEFAULT_SEARCH_MODE = os.environ.get('LLAVA_SEARCH_MODE', 'vector')
+
+# Endpoints that write files, modify the index or need the LLaVA model
+WRITE_ENDPOINTS = {'upload_chat_image', 'chat', 'delete_chat_session', 'index_image'}
+
+# Node-specific settings written by `python verify_setup.py --profile`
+PERF_PROFILE = perf_profile.load_profile()
+if PERF_PROFILE:
+    print(f"Loaded performance profile from {perf_profile.PROFILE_PATH}: {PERF_PROFILE.get('settings', {})}")
+else:
+    print("No performance profile found; run `python verify_setup.py --profile` to tune this machine")
 
 # Create uploads folder if it doesn't exist
 Path(app.config['UPLOAD_FOLDER']).mkdir(exist_ok=True)
 
-# Model and database will be lazy-loaded on first request
-model = None
+# Compress JSON (caption-heavy listings) for clients that accept it
+app.after_request(http_cache.compress_response)
+
+@app.before_request
+def reject_writes_when_read_only():
+    """Keep read-only (search) workers from loading LLaVA or writing to the index"""
+    if app.config['READ_ONLY'] and request.endpoint in WRITE_ENDPOINTS:
+        return jsonify({
+            'success': False,
+            'error': 'This server is read-only; send uploads and chat to a caption worker'
+        }), 403
+
+# Database will be lazy-loaded on first request; the model is owned by llava_backend
+# so it can be unloaded when idle (see LLAVA_IDLE_UNLOAD_SECONDS)
 db = None
 
+def get_caption_model():
+    """Load LLaVA on first use (importing llava_backend pulls in torch and LLaVA-NeXT)"""
+    import llava_backend
+    return llava_backend.get_model()
+
+def caption_model():
+    """Context manager yielding the LLaVA model, keeping it loaded while in use"""
+    import llava_backend
+    return llava_backend.use_model()
+
 @app.route('/')
 def index():
     """Main page - redirect to upload page"""
@@ -37,24 +78,132 @@ def gallery_page():
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """Serve an uploaded image with an mtime/size ETag"""
+    path = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(filename))
+    if not os.path.isfile(path):
+        return jsonify({'success': False, 'error': 'File not found'}), 404
+    
+    etag = http_cache.file_etag(path)
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, etag=etag)
+    
+    # Versioned URLs name one version of the file; plain URLs must be revalidated
+    if request.args.get('v') == etag:
+        response.headers['Cache-Control'] = http_cache.IMMUTABLE_CACHE_CONTROL
+    else:
+        response.headers['Cache-Control'] = http_cache.REVALIDATE_CACHE_CONTROL
+    return response
+
+def image_url(filename):
+    """Get the versioned URL for an uploaded image"""
+    return http_cache.versioned_url(
+        f'/uploads/{filename}',
+        os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    )
+
+@app.route('/upload', methods=['POST'])
+def upload_chat_image():
+    """Upload an image for the chat page (no captioning or indexing)"""
+    if 'file' not in request.files:
+        return jsonify({'success': False, 'error': 'No file part'}), 400
+    
+    file = request.files['file']
+    
+    if file.filename == '':
+        return jsonify({'success': False, 'error': 'No selected file'}), 400
+    
+    filename = os.path.basename(file.filename)
+    file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    
+    return jsonify({
+        'success': True,
+        'filename': filename,
+        'url': image_url(filename)
+    })
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    """Run one turn of a multi-turn chat session, reusing its KV cache"""
+    try:
+        data = request.json or {}
+        prompt = data.get('prompt', '')
+        
+        if not prompt:
+            return jsonify({'success': False, 'error': 'No prompt provided'}), 400
+        
+        image_paths = []
+        for name in data.get('image_paths', []):
+            path = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(name))
+            if not os.path.exists(path):
+                return jsonify({'success': False, 'error': f'Image not found: {name}'}), 400
+            image_paths.append(path)
+        
+        store = chat_sessions.get_session_store()
+        session, session_reset = store.get_or_create(data.get('session_id'))
+        
+        with session.lock, caption_model() as model:
+            try:
+                result = model.chat_turn(session, prompt, image_paths, policy=data.get('policy', 'chat'))
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e), 'session_id': session.session_id}), 400
+        store.touch(session)
+        
+        return jsonify({
+            'success': True,
+            'session_id': session.session_id,
+            'session_reset': session_reset,
+            **result
+        })
+        
+    except Exception as e:
+        import traceback
+        error_msg = str(e)
+        traceback_str = traceback.format_exc()
+        print(f"Error in chat: {error_msg}")
+        print(traceback_str)
+        
+        return jsonify({
+            'success': False,
+            'error': error_msg
+        }), 500
+
+@app.route('/chat/<session_id>', methods=['DELETE'])
+def delete_chat_session(session_id):
+    """End a chat session and free its KV cache"""
+    deleted = chat_sessions.get_session_store().delete(session_id)
+    return jsonify({'success': deleted})
+
+@app.route('/api/chat-sessions', methods=['GET'])
+def get_chat_sessions():
+    """Get chat session store statistics"""
+    return jsonify({
+        'success': True,
+        **chat_sessions.get_session_store().stats()
+    })
+
+def visual_budget_from_request():
+    """Per-request visual budget from form fields (None = deployment default)"""
+    mode = request.form.get('visual_budget')
+    if not mode:
+        return None
+    limits = {key: int(request.form[key])
+              for key in ('max_tiles', 'max_pixels', 'max_visual_tokens') if request.form.get(key)}
+    return {'mode': mode, **limits}
 
 @app.route('/api/index-image', methods=['POST'])
 def index_image():
     """Upload an image, generate caption with LLaVA, and index it"""
-    global model, db
+    global db
     try:
-        # Lazy load model and database
-        if model is None:
-            print("Loading LLaVA One Vision model...")
-            model = llava_backend.get_model()
-            print("Model ready!")
-        
+        # Lazy load database
         if db is None:
             print("Loading vector database...")
             db = vector_db.get_db()
             print("Database ready!")
         
+        if not db.accepts_writes():
+            return jsonify({'success': False,
+                            'error': 'A snapshot is being imported; try again once it finishes'}), 503
+        
         if 'file' not in request.files:
             return jsonify({'success': False, 'error': 'No file part'}), 400
         
@@ -63,23 +212,55 @@ def index_image():
         if file.filename == '':
             return jsonify({'success': False, 'error': 'No selected file'}), 400
         
+        # Reject bad options before saving the file or waiting for the model
+        import llava_backend
+        try:
+            policy = llava_backend.get_caption_policy(request.form.get('policy', 'caption'))
+            visual_budget = llava_backend.VisualBudget.coerce(visual_budget_from_request())
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
         # Save the file
         filename = file.filename
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         
-        # Generate caption using LLaVA
-        caption_prompt = "Describe this image in detail."
-        caption = model.chat(caption_prompt, [filepath])
+        # Reuse the caption and embedding of a near-identical image instead of running LLaVA
+        if dedupe.dedupe_enabled():
+            dedupe_index = dedupe.get_dedupe_index()
+            hashes = dedupe_index.compute_hashes(filepath)
+            match = dedupe_index.find(hashes)
+            original = db.get_image(match[0]) if match and match[0] != filename else None
+            if original:
+                db.add_image(filename, original['caption'],
+                             metadata={'duplicate_of': match[0]}, embedding=original['embedding'])
+                dedupe_index.add(filename, hashes, duplicate_of=match[0])
+                return jsonify({
+                    'success': True,
+                    'filename': filename,
+                    'caption': original['caption'],
+                    'url': image_url(filename),
+                    'duplicate_of': match[0],
+                    'similarity': match[1]
+                })
+        
+        # Generate caption using LLaVA; the policy bounds its length (caption or short-tag)
+        start = time.perf_counter()
+        with caption_model() as model:
+            caption = model.caption(filepath, policy=policy, visual_budget=visual_budget)
+        caption_seconds = time.perf_counter() - start
         
         # Index in vector database
         db.add_image(filename, caption)
+        if dedupe.dedupe_enabled():
+            dedupe_index.add(filename, hashes)
+            dedupe_index.record_caption_time(caption_seconds)
         
         return jsonify({
             'success': True,
             'filename': filename,
             'caption': caption,
-            'url': f'/uploads/{filename}'
+            'url': image_url(filename)
         })
         
     except Exception as e:
@@ -106,19 +287,23 @@ def search_images():
         data = request.json
         query = data.get('query', '')
         n_results = data.get('n_results', 10)
+        mode = data.get('mode', DEFAULT_SEARCH_MODE)
         
         if not query:
             return jsonify({'success': False, 'error': 'No query provided'}), 400
+        if mode not in vector_db.SEARCH_MODES:
+            return jsonify({'success': False, 'error': f'Unknown search mode: {mode}'}), 400
         
         # Search in vector database
-        results = db.search(query, n_results)
+        results = db.search(query, n_results, mode=mode)
         
         # Add full URL to each result
         for result in results:
-            result['url'] = f"/uploads/{result['image_path']}"
+            result['url'] = image_url(result['image_path'])
         
         return jsonify({
             'success': True,
+            'mode': mode,
             'results': results,
             'count': len(results)
         })
@@ -144,18 +329,22 @@ def get_all_images():
         if db is None:
             db = vector_db.get_db()
         
-        # Get all from database
-        results = db.get_all()
+        def build_payload():
+            # Get all from database
+            results = db.get_all()
+            
+            # Add full URL to each result
+            for result in results:
+                result['url'] = image_url(result['image_path'])
+            
+            return {
+                'success': True,
+                'results': results,
+                'count': len(results)
+            }
         
-        # Add full URL to each result
-        for result in results:
-            result['url'] = f"/uploads/{result['image_path']}"
-        
-        return jsonify({
-            'success': True,
-            'results': results,
-            'count': len(results)
-        })
+        # Unchanged collection -> 304 without touching the database
+        return http_cache.conditional_json(db.etag(), build_payload)
         
     except Exception as e:
         import traceback
@@ -177,16 +366,46 @@ def get_stats():
         if db is None:
             db = vector_db.get_db()
         
-        return jsonify({
-            'success': True,
-            'total_images': db.count()
-        })
+        def build_payload():
+            payload = {
+                'success': True,
+                'total_images': db.count(),
+                'lexical_index': db.lexical_index.stats(),
+                'snapshot_import': db.import_status()
+            }
+            if dedupe.dedupe_enabled():
+                payload['dedupe'] = dedupe.get_dedupe_index().stats()
+            return payload
+        
+        return http_cache.conditional_json(db.etag(), build_payload)
     except Exception as e:
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+@app.route('/api/model-status', methods=['GET'])
+def get_model_status():
+    """Get load/unload events and timings for the models in this process"""
+    import model_manager
+    return jsonify({
+        'success': True,
+        'models': model_manager.all_stats()
+    })
+
+@app.route('/api/generation-stats', methods=['GET'])
+def get_generation_stats():
+    """Get generated-token and latency statistics per generation policy"""
+    import sys
+    # Search-only workers never import llava_backend, so there is nothing to report
+    if 'llava_backend' not in sys.modules:
+        return jsonify({'success': True, 'policies': {}})
+    import llava_backend
+    return jsonify({
+        'success': True,
+        'policies': llava_backend.generation_stats()
+    })
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
 
@@ -0,0 +1,119 @@
+"""
+Captioning Benchmark for LLaVA Image Search
+Compares caption latency and quality across visual-token budgets
+
+Quality is the cosine similarity between each caption's embedding and the
+embedding of the caption produced with the full anyres grid, i.e. how much
+the searchable meaning of the caption changes when the budget is cut.
+
+Usage:
+    python benchmark_captioning.py --images uploads/
+    python benchmark_captioning.py --images uploads/ --budgets full single max_tiles=4 auto=3000
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import llava_backend
+import vector_db
+
+CAPTION_PROMPT = "Describe this image in detail."
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif")
+
+# Shorthand "<mode>=<n>" maps to the budget argument the number belongs to
+SHORTHAND_ARGUMENTS = {"max_tiles": "max_tiles", "max_pixels": "max_pixels", "auto": "max_visual_tokens"}
+
+
+def parse_budget(spec):
+    """
+    Parse a budget spec such as 'single', 'max_tiles=4' or 'auto=3000'
+
+    Returns:
+        llava_backend.VisualBudget
+    """
+    if "=" not in spec:
+        return llava_backend.VisualBudget(spec)
+    mode, value = spec.split("=", 1)
+    return llava_backend.VisualBudget(mode, **{SHORTHAND_ARGUMENTS[mode]: int(value)})
+
+
+def list_images(paths, limit):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            files.append(path)
+    return files[:limit] if limit else files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark caption latency/quality per visual budget")
+    parser.add_argument("--images", nargs="+", default=["uploads"], help="Image files or directories")
+    parser.add_argument("--budgets", nargs="+", default=["full", "auto=3000", "max_tiles=4", "single"])
+    parser.add_argument("--limit", type=int, default=20, help="Maximum number of images")
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--json", help="Write per-budget results to this file")
+    args = parser.parse_args()
+
+    images = list_images(args.images, args.limit)
+    if not images:
+        print("No images found.")
+        return
+    # The full-grid run comes first: it is the quality and speed reference
+    budgets = [("full", llava_backend.VisualBudget("full"))]
+    budgets += [(spec, parse_budget(spec)) for spec in args.budgets if spec != "full"]
+
+    model = llava_backend.get_model()
+    embedder = vector_db.get_embedding_model()
+
+    captions = {spec: [] for spec, _ in budgets}
+    results = []
+    for spec, budget in budgets:
+        latencies = []
+        tiles = []
+        tokens = []
+        for image_path in images:
+            estimate = model.estimate_visual_tokens([image_path], budget)
+            start = time.perf_counter()
+            caption = model.generate_response(CAPTION_PROMPT, [image_path], max_new_tokens=args.max_new_tokens,
+                                              do_sample=False, visual_budget=budget)
+            latencies.append(time.perf_counter() - start)
+            tiles.append(estimate['tiles'])
+            tokens.append(estimate['approx_visual_tokens'])
+            captions[spec].append(caption)
+        results.append({
+            "budget": spec,
+            "mean_seconds": float(np.mean(latencies)),
+            "p95_seconds": float(np.percentile(latencies, 95)),
+            "mean_tiles": float(np.mean(tiles)),
+            "mean_visual_tokens": float(np.mean(tokens)),
+        })
+        print(f"   ✓ {spec}: {np.mean(latencies):.2f}s per image")
+
+    # Quality: similarity of each caption to the full-budget caption
+    reference = embedder.encode(captions["full"], normalize_embeddings=True)
+    for result in results:
+        embeddings = embedder.encode(captions[result["budget"]], normalize_embeddings=True)
+        result["similarity_to_full"] = float(np.mean(np.sum(embeddings * reference, axis=1)))
+        result["speedup"] = results[0]["mean_seconds"] / result["mean_seconds"]
+
+    print()
+    print(f"{len(images)} images, greedy decoding, max_new_tokens={args.max_new_tokens}")
+    print(f"{'budget':<16} {'tiles':>6} {'~tokens':>8} {'mean s':>7} {'p95 s':>7} {'speedup':>8} {'quality':>8}")
+    for r in results:
+        print(f"{r['budget']:<16} {r['mean_tiles']:>6.1f} {r['mean_visual_tokens']:>8.0f} {r['mean_seconds']:>7.2f} "
+              f"{r['p95_seconds']:>7.2f} {r['speedup']:>7.2f}x {r['similarity_to_full']:>8.3f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"images": images, "results": results, "captions": captions}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
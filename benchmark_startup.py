@@ -0,0 +1,110 @@
+"""
+Startup Benchmark for LLaVA Image Search
+Measures import time, time-to-ready and peak RSS of each process mode,
+each in a fresh interpreter
+
+Usage:
+    python benchmark_startup.py
+    python benchmark_startup.py --modes search search-query
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Code run in the child process; prints one JSON line with the measurements
+CHILD_CODE = r'''
+import json, os, sys, time
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KB on Linux and bytes on macOS
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+mode = sys.argv[1]
+start = time.perf_counter()
+import app
+import_seconds = time.perf_counter() - start
+
+if mode in ("search", "search-query"):
+    db = app.vector_db.get_db()
+    db.get_all()
+    if mode == "search-query":
+        db.search("a photo", 5)
+elif mode == "full-import":
+    import llava_backend
+elif mode == "full":
+    app.get_caption_model()
+
+print(json.dumps({
+    "mode": mode,
+    "import_seconds": round(import_seconds, 3),
+    "ready_seconds": round(time.perf_counter() - start, 3),
+    "peak_rss_mb": peak_rss_mb(),
+    "torch_imported": "torch" in sys.modules,
+    "llava_imported": "llava_backend" in sys.modules,
+}))
+'''
+
+MODES = {
+    "search": "Search-only: import app, open the index, list images",
+    "search-query": "Search-only plus one query (loads the embedder)",
+    "full-import": "Captioning enabled: import llava_backend (torch + LLaVA-NeXT)",
+    "full": "Captioning enabled: load the LLaVA model",
+}
+
+
+def run_mode(mode):
+    """
+    Run one mode in a fresh interpreter
+
+    Args:
+        mode: One of MODES
+
+    Returns:
+        Dictionary of measurements, or an error description
+    """
+    env = dict(os.environ)
+    env["LLAVA_SEARCH_ONLY"] = "1" if mode.startswith("search") else "0"
+    proc = subprocess.run(
+        [sys.executable, "-c", CHILD_CODE, mode],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith("{"):
+            return json.loads(line)
+    return {"mode": mode, "error": proc.stderr.strip().splitlines()[-1:] or "no output"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure startup time and memory per process mode")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=["search", "search-query", "full-import"],
+                        help="Modes to measure ('full' loads the LLaVA weights and is slow)")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("LLaVA Image Search - Startup Benchmark")
+    print("=" * 60)
+    for mode in args.modes:
+        print(f"\n{mode}: {MODES[mode]}")
+        result = run_mode(mode)
+        if "error" in result:
+            print(f"   ✗ {result['error']}")
+            continue
+        print(f"   import app:   {result['import_seconds']:.2f}s")
+        print(f"   ready:        {result['ready_seconds']:.2f}s")
+        print(f"   peak RSS:     {result['peak_rss_mb']} MB")
+        print(f"   torch loaded: {result['torch_imported']}")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+Chat Session Store
+Keeps multi-turn conversations and their KV caches in memory so that each
+new turn only has to prefill the new user tokens
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import perf_profile
+
+
+def kv_cache_nbytes(past_key_values) -> int:
+    """
+    Estimate the memory held by a KV cache
+
+    Args:
+        past_key_values: Legacy tuple-of-tuples cache (or None)
+
+    Returns:
+        Number of bytes held by the cached key/value tensors
+    """
+    if past_key_values is None:
+        return 0
+    total = 0
+    for layer in past_key_values:
+        for tensor in layer:
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class ChatSession:
+    """A single multi-turn conversation with its retained KV cache"""
+
+    def __init__(self, session_id: str):
+        """
+        Initialize an empty session
+
+        Args:
+            session_id: Unique identifier for the session
+        """
+        self.session_id = session_id
+        self.messages = []  # List of (role, message) pairs, as in conv_templates
+        self.image_paths = []  # Images already encoded into the cache
+        self.past_key_values = None
+        self.cached_text = ""  # Prompt text represented by past_key_values
+        self.cached_tokens = 0
+        self.turns = 0
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.lock = threading.Lock()
+
+    def reset_cache(self):
+        """Drop the KV cache; the next turn re-prefills the whole conversation"""
+        self.past_key_values = None
+        self.cached_text = ""
+        self.cached_tokens = 0
+
+    def cache_bytes(self) -> int:
+        """Get the memory held by this session's KV cache"""
+        return kv_cache_nbytes(self.past_key_values)
+
+    def to_dict(self) -> Dict:
+        """Summarize the session for API responses"""
+        return {
+            'session_id': self.session_id,
+            'turns': self.turns,
+            'images': list(self.image_paths),
+            'cached_tokens': self.cached_tokens,
+            'cache_bytes': self.cache_bytes(),
+            'idle_seconds': round(time.time() - self.last_used, 1)
+        }
+
+
+class ChatSessionStore:
+    """In-memory session store with LRU/TTL eviction and a KV-cache memory cap"""
+
+    def __init__(self, max_sessions: int = 32, ttl_seconds: float = 30 * 60,
+                 max_cache_bytes: int = 4 * 1024 ** 3):
+        """
+        Initialize the session store
+
+        Args:
+            max_sessions: Maximum number of live sessions
+            ttl_seconds: Sessions idle for longer than this are evicted
+            max_cache_bytes: Total KV-cache memory allowed across all sessions
+        """
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_cache_bytes = max_cache_bytes
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def create(self) -> ChatSession:
+        """Create a new session, evicting old ones if needed"""
+        session = ChatSession(uuid.uuid4().hex)
+        with self._lock:
+            self._sessions[session.session_id] = session
+            self._evict_locked(keep=session.session_id)
+        return session
+
+    def get(self, session_id: Optional[str]) -> Optional[ChatSession]:
+        """
+        Look up a live session and mark it as most recently used
+
+        Args:
+            session_id: Session identifier
+
+        Returns:
+            The session, or None if it does not exist or has expired
+        """
+        if not session_id:
+            return None
+        with self._lock:
+            self._expire_locked()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.time()
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def get_or_create(self, session_id: Optional[str]) -> Tuple[ChatSession, bool]:
+        """
+        Return the requested session, or a fresh one if it is unknown
+        
+        Returns:
+            Tuple of (session, reset). reset is True when a session_id was given
+            but has expired or been evicted, so its history is gone.
+        """
+        session = self.get(session_id)
+        if session is not None:
+            return session, False
+        return self.create(), bool(session_id)
+
+    def touch(self, session: ChatSession):
+        """
+        Record that a session was used and enforce the memory cap
+
+        Call this after a turn so the new KV cache size is accounted for.
+        """
+        with self._lock:
+            session.last_used = time.time()
+            if session.session_id in self._sessions:
+                self._sessions.move_to_end(session.session_id)
+            self._evict_locked(keep=session.session_id)
+
+    def delete(self, session_id: str) -> bool:
+        """Delete a session and free its KV cache"""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        session.reset_cache()
+        return True
+
+    def total_cache_bytes(self) -> int:
+        """Get the KV-cache memory held by all sessions"""
+        with self._lock:
+            return sum(s.cache_bytes() for s in self._sessions.values())
+
+    def stats(self) -> Dict:
+        """Get store statistics"""
+        with self._lock:
+            sessions: List[Dict] = [s.to_dict() for s in self._sessions.values()]
+        return {
+            'sessions': len(sessions),
+            'max_sessions': self.max_sessions,
+            'ttl_seconds': self.ttl_seconds,
+            'cache_bytes': sum(s['cache_bytes'] for s in sessions),
+            'max_cache_bytes': self.max_cache_bytes,
+            'evictions': self.evictions
+        }
+
+    def _expire_locked(self):
+        now = time.time()
+        expired = [sid for sid, s in self._sessions.items()
+                   if now - s.last_used > self.ttl_seconds]
+        for sid in expired:
+            self._drop_locked(sid)
+
+    def _evict_locked(self, keep: Optional[str] = None):
+        self._expire_locked()
+
+        # Oldest sessions sit at the front of the OrderedDict
+        def candidates():
+            return [sid for sid in self._sessions if sid != keep]
+
+        while len(self._sessions) > self.max_sessions and candidates():
+            self._drop_locked(candidates()[0])
+
+        total = sum(s.cache_bytes() for s in self._sessions.values())
+        for sid in candidates():
+            if total <= self.max_cache_bytes:
+                break
+            total -= self._sessions[sid].cache_bytes()
+            self._drop_locked(sid)
+
+        # A single session larger than the cap keeps its history but not its cache
+        if total > self.max_cache_bytes and keep in self._sessions:
+            self._sessions[keep].reset_cache()
+
+    def _drop_locked(self, session_id: str):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            session.reset_cache()
+            self.evictions += 1
+
+
+# Global session store instance
+_store_instance = None
+
+
+def get_session_store():
+    """Get or create the global chat session store (memory cap from the performance profile)"""
+    global _store_instance
+    if _store_instance is None:
+        _store_instance = ChatSessionStore(
+            max_cache_bytes=perf_profile.get("kv_cache_budget_bytes", 4 * 1024 ** 3)
+        )
+    return _store_instance
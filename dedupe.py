@@ -0,0 +1,319 @@
+"""
+Near-Duplicate Image Index
+Perceptual hashes (pHash + dHash) in a BK-tree, so resized, re-compressed or
+lightly cropped copies of an indexed image can reuse its caption instead of
+being captioned by LLaVA again
+
+The index is persisted as an append-only JSON Lines log. Appends and
+rewrites take the same cross-process file lock as the lexical index, and
+every read first replays lines appended by other processes (e.g. other
+server workers).
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from lexical_index import exclusive_file_lock
+
+HASH_BITS = 64
+
+
+def hamming(a: int, b: int) -> int:
+    """Number of differing bits between two hashes"""
+    return bin(a ^ b).count("1")
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    return np.cos(np.pi * (2 * x + 1) * k / (2 * n))
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def phash(image: Image.Image) -> int:
+    """
+    64-bit perceptual hash: sign of the low-frequency DCT coefficients
+    relative to their median
+    """
+    pixels = np.asarray(image.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    coeffs = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8].flatten()
+    median = np.median(coeffs[1:])  # DC term only encodes overall brightness
+    return _bits_to_int(coeffs > median)
+
+
+def dhash(image: Image.Image) -> int:
+    """64-bit difference hash: whether each pixel is brighter than its right neighbour"""
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return _bits_to_int((pixels[:, 1:] > pixels[:, :-1]).flatten())
+
+
+def _bits_to_int(bits) -> int:
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+class BKTree:
+    """Burkhard-Keller tree for radius search under Hamming distance"""
+
+    def __init__(self):
+        # Node: [hash, {distance: child_node}, [items]]
+        self.root = None
+
+    def add(self, value: int, item: str):
+        """Insert a hash; items with identical hashes share a node"""
+        if self.root is None:
+            self.root = [value, {}, [item]]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[2].append(item)
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [value, {}, [item]]
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, int, List[str]]]:
+        """
+        Find every hash within max_distance
+
+        Returns:
+            List of (distance, hash, items), nearest first
+        """
+        if self.root is None:
+            return []
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.append((distance, node[0], node[2]))
+            # Triangle inequality: only children in this band can be within range
+            for child_distance, child in node[1].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda f: f[0])
+        return found
+
+
+class NearDuplicateIndex:
+    """Persistent perceptual-hash index with near-duplicate groups and savings stats"""
+
+    def __init__(self, path: str = "./chroma_db/near_duplicates.jsonl", min_similarity: float = 0.9):
+        """
+        Initialize the index, replaying its log from disk if it exists
+
+        Each change is appended to a JSON Lines log, so an upload costs one
+        short write however many images are indexed.
+
+        Args:
+            path: JSON Lines log the index is persisted to (next to the vector database)
+            min_similarity: Hash similarity (1 - hamming / 64) needed to reuse a caption
+        """
+        self.path = path
+        self.min_similarity = min_similarity
+        self.max_distance = int((1 - min_similarity) * HASH_BITS)
+        self._lock = threading.RLock()
+        self._reset()
+        self.refresh()
+
+    def compute_hashes(self, image_path: str) -> Tuple[int, int]:
+        """Compute (pHash, dHash) for an image file"""
+        with Image.open(image_path) as image:
+            image = image.convert("RGB")
+            return phash(image), dhash(image)
+
+    def find(self, hashes: Tuple[int, int]) -> Optional[Tuple[str, float]]:
+        """
+        Find the closest indexed image within the similarity threshold
+
+        Both hashes must agree, which keeps pHash collisions between
+        different images from reusing the wrong caption.
+
+        Returns:
+            (group representative filename, similarity), or None
+        """
+        p_hash, d_hash = hashes
+        with self._lock:
+            self._refresh_locked()
+            for distance, node_hash, items in self.tree.search(p_hash, self.max_distance):
+                for filename in items:
+                    stored = self.hashes.get(filename)
+                    # Skip entries replaced or removed since they were inserted
+                    if stored is None or stored[0] != node_hash:
+                        continue
+                    if hamming(stored[1], d_hash) > self.max_distance:
+                        continue
+                    similarity = 1 - max(distance, hamming(stored[1], d_hash)) / HASH_BITS
+                    representative = self.duplicate_of.get(filename, filename)
+                    if representative not in self.hashes:
+                        representative = filename
+                    return representative, round(similarity, 4)
+        return None
+
+    def add(self, filename: str, hashes: Tuple[int, int], duplicate_of: Optional[str] = None):
+        """
+        Record an indexed image
+
+        Args:
+            filename: Image filename (as stored in the vector database)
+            hashes: (pHash, dHash) from compute_hashes
+            duplicate_of: Representative of the near-duplicate group, if any
+        """
+        self._write({"op": "add", "file": filename, "phash": format(hashes[0], "016x"),
+                     "dhash": format(hashes[1], "016x"), "duplicate_of": duplicate_of})
+
+    def remove(self, filename: str):
+        """
+        Forget an image (its tree entry is skipped on lookup)
+
+        If it represented a near-duplicate group, the group's remaining
+        members are re-pointed to one of them.
+        """
+        with self._file_lock():
+            self._refresh_locked()
+            if filename not in self.hashes:
+                return
+            self._append_locked({"op": "remove", "file": filename})
+
+    def clear(self):
+        """Forget every image and reset the savings counters"""
+        with self._file_lock():
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            open(temp_path, "w", encoding="utf-8").close()
+            os.replace(temp_path, self.path)
+            self._reset()
+            self._refresh_locked()
+
+    def refresh(self):
+        """Apply log lines written since the last refresh (by this or another process)"""
+        with self._lock:
+            self._refresh_locked()
+
+    def record_caption_time(self, seconds: float):
+        """Record how long a real caption took, to estimate the time saved by reuse"""
+        self._write({"op": "caption_time", "seconds": round(seconds, 3)})
+
+    def stats(self) -> Dict:
+        """Get dedupe savings for /api/stats"""
+        with self._lock:
+            self._refresh_locked()
+            duplicates = len(self.duplicate_of)
+            avg_caption = self.caption_seconds / self.caption_count if self.caption_count else 0.0
+            return {
+                'near_duplicates': duplicates,
+                'duplicate_groups': len(set(self.duplicate_of.values())),
+                'captions_skipped': duplicates,
+                'avg_caption_seconds': round(avg_caption, 2),
+                'estimated_seconds_saved': round(duplicates * avg_caption, 1),
+                'min_similarity': self.min_similarity
+            }
+
+    def _write(self, record: Dict):
+        with self._file_lock():
+            self._append_locked(record)
+
+    def _append_locked(self, record: Dict):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+        self._refresh_locked()
+
+    def _refresh_locked(self):
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            if self._offset:
+                self._reset()
+            return
+        with f:
+            # Stat the open file, not the path, in case another process replaces the log meanwhile
+            stat = os.fstat(f.fileno())
+            # The log was replaced (clear elsewhere): replay it from the start
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                self._reset()
+                self._inode = stat.st_ino
+            if stat.st_size == self._offset:
+                return
+            f.seek(self._offset)
+            data = f.read()
+        # Leave a partially written last line for the next refresh
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, KeyError) as e:
+                print(f"Skipping unreadable line in near-duplicate index {self.path}: {e}")
+        self._offset += end
+
+    @contextmanager
+    def _file_lock(self):
+        """Hold the in-process lock and an exclusive lock on <path>.lock"""
+        with self._lock, exclusive_file_lock(self.path + ".lock"):
+            yield
+
+    def _reset(self):
+        self.hashes: Dict[str, Tuple[int, int]] = {}  # filename -> (phash, dhash)
+        self.duplicate_of: Dict[str, str] = {}  # filename -> group representative
+        self.caption_count = 0
+        self.caption_seconds = 0.0
+        self.tree = BKTree()
+        self._offset = 0
+        self._inode: Optional[int] = None
+
+    def _apply(self, record: Dict):
+        op = record["op"]
+        if op == "add":
+            filename = record["file"]
+            hashes = (int(record["phash"], 16), int(record["dhash"], 16))
+            self.hashes[filename] = hashes
+            self.tree.add(hashes[0], filename)
+            duplicate_of = record.get("duplicate_of")
+            if duplicate_of and duplicate_of != filename:
+                self.duplicate_of[filename] = duplicate_of
+            else:
+                self.duplicate_of.pop(filename, None)
+        elif op == "remove":
+            filename = record["file"]
+            self.hashes.pop(filename, None)
+            self.duplicate_of.pop(filename, None)
+            # Promote the first remaining member of the removed image's group
+            members = [f for f, rep in self.duplicate_of.items() if rep == filename]
+            if members:
+                del self.duplicate_of[members[0]]
+                for member in members[1:]:
+                    self.duplicate_of[member] = members[0]
+        elif op == "caption_time":
+            self.caption_count += 1
+            self.caption_seconds += record["seconds"]
+
+
+# Global index instance. LLAVA_DEDUPE_MIN_SIMILARITY sets the reuse threshold;
+# LLAVA_DEDUPE=0 turns near-duplicate detection off.
+_index_instance = None
+
+
+def dedupe_enabled() -> bool:
+    return os.environ.get("LLAVA_DEDUPE", "1") != "0"
+
+
+def get_dedupe_index():
+    """Get or create the global near-duplicate index"""
+    global _index_instance
+    if _index_instance is None:
+        _index_instance = NearDuplicateIndex(
+            min_similarity=float(os.environ.get("LLAVA_DEDUPE_MIN_SIMILARITY", "0.9"))
+        )
+    return _index_instance
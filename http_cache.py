@@ -0,0 +1,115 @@
+"""
+HTTP Caching Helpers
+ETags, conditional GETs, Cache-Control and response compression for the Flask app
+"""
+import gzip
+import os
+from typing import Callable, Dict
+
+from flask import Response, jsonify, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/css', 'application/javascript', 'text/javascript'}
+
+# Content-addressed URLs (?v=<etag>) never change, so they can be cached forever
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+def file_etag(path: str) -> str:
+    """
+    Get an ETag for a file from its modification time and size
+
+    A single stat call, so listings can version every image URL without
+    reading the files, and every worker process derives the same value.
+
+    Args:
+        path: Path to the file
+
+    Returns:
+        Hex string identifying this version of the file
+    """
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def versioned_url(url: str, path: str) -> str:
+    """
+    Make a versioned URL for a file so clients can cache it immutably
+
+    Args:
+        url: Public URL of the file
+        path: Path to the file on disk
+
+    Returns:
+        URL with a ?v=<etag> query string, or the plain URL if the file is missing
+    """
+    try:
+        return f"{url}?v={file_etag(path)}"
+    except OSError:
+        return url
+
+
+def conditional_json(etag: str, build_payload: Callable[[], Dict]) -> Response:
+    """
+    Answer a GET with 304 Not Modified if the client already has this version
+
+    The payload is only built when the client's copy is stale, so polling
+    clients cost neither serialization nor bandwidth.
+
+    Args:
+        etag: Version of the underlying data (e.g. ImageCaptionVectorDB.etag())
+        build_payload: Callable returning the JSON payload
+
+    Returns:
+        Flask response with a weak ETag set
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build_payload())
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = REVALIDATE_CACHE_CONTROL
+    return response
+
+
+def compress_response(response: Response) -> Response:
+    """
+    Compress a response with brotli or gzip if the client accepts it
+
+    Intended to be registered with ``app.after_request``. Brotli is used when
+    the optional ``brotli`` package is installed.
+    """
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        encoding = 'br'
+    elif accepted['gzip']:
+        encoding = 'gzip'
+    else:
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    if encoding == 'br':
+        data = brotli.compress(data, quality=5)
+    else:
+        data = gzip.compress(data, compresslevel=6)
+
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,295 @@
+"""
+Lexical Caption Index
+BM25 inverted index over captions, so exact-term queries (object names,
+OCR'd text) can be answered without encoding the query with the embedder
+
+The index is persisted as an append-only JSON Lines log next to the vector
+database. Every change is one appended line and other processes (e.g. search
+workers) replay new lines before searching, so they see images indexed by a
+caption worker without restarting. Appends and log rewrites (rebuilds and
+compaction) take an exclusive file lock, so a rewrite never drops lines
+appended by another process.
+"""
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Compact once the log holds this many more lines than live captions (re-adds and deletes)
+COMPACT_MIN_DEAD_LINES = 1000
+
+# Common English words that carry no meaning in captions ("The image shows a ...")
+STOPWORDS = frozenset("""
+a an and are as at be been being but by can for from has have in into is it its
+of on or that the their there these this those to was were which while with
+image picture photo shows showing appears depicts features visible also
+""".split())
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+@contextmanager
+def exclusive_file_lock(lock_path: str):
+    """Hold an exclusive lock on lock_path (created if missing) across processes"""
+    Path(lock_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a+b") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into index terms
+
+    Lowercases, drops stopwords and strips a plural 's' so that "dogs"
+    matches "dog".
+    """
+    terms = []
+    for token in _TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        terms.append(token)
+    return terms
+
+
+class BM25Index:
+    """Incrementally maintained BM25 inverted index over image captions"""
+
+    def __init__(self, path: str = "./chroma_db/lexical_index.jsonl", k1: float = 1.2, b: float = 0.75):
+        """
+        Initialize the index, replaying its log from disk if it exists
+
+        Args:
+            path: JSON Lines log the index is persisted to (next to the vector database)
+            k1: Term-frequency saturation
+            b: Document-length normalization (0 = none, 1 = full)
+        """
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._reset()
+
+    def add(self, image_path: str, caption: str):
+        """Index (or re-index) an image's caption"""
+        self._append([{"op": "add", "path": image_path, "caption": caption}])
+
+    def remove(self, image_path: str):
+        """Remove an image from the index"""
+        self._append([{"op": "delete", "path": image_path}])
+
+    def clear(self):
+        """Remove every image"""
+        self.rebuild(lambda: [])
+
+    def rebuild(self, load_items: Callable[[], Iterable[Tuple[str, str]]],
+                expected_count: Optional[int] = None) -> bool:
+        """
+        Replace the index contents, rewriting (and compacting) the log
+
+        load_items is called while the file lock is held, so captions written
+        by other processes are either in what it returns or appended after
+        the new log is in place.
+
+        Args:
+            load_items: Callable returning (image_path, caption) pairs
+            expected_count: Skip the rebuild if, once the lock is held, the
+                index already has this many captions (another process rebuilt it)
+
+        Returns:
+            True if the log was rewritten
+        """
+        with self._file_lock():
+            self._refresh_locked()
+            if expected_count is not None and len(self.doc_terms) == expected_count:
+                return False
+            self._rewrite_locked(load_items())
+        return True
+
+    def compact(self):
+        """Rewrite the log with one line per live caption"""
+        with self._file_lock():
+            self._refresh_locked()
+            self._rewrite_locked(list(self.captions.items()))
+
+    def refresh(self):
+        """Apply log lines written since the last refresh (by this or another process)"""
+        with self._lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            if self._offset:
+                self._reset()
+            return
+        with f:
+            # Stat the open file, not the path, in case another process replaces the log meanwhile
+            stat = os.fstat(f.fileno())
+            # The log was replaced (rebuild or compaction elsewhere): replay it from the start
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                self._reset()
+                self._inode = stat.st_ino
+            if stat.st_size == self._offset:
+                return
+            f.seek(self._offset)
+            data = f.read()
+        # Leave a partially written last line for the next refresh
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                self._apply(json.loads(line))
+            except ValueError:
+                print(f"Skipping unreadable line in lexical index {self.path}")
+            self._lines += 1
+        self._offset += end
+
+    def search(self, query_text: str, n_results: int = 10) -> List[Dict]:
+        """
+        Rank captions by BM25 score
+
+        Args:
+            query_text: Text query to search for
+            n_results: Number of results to return
+
+        Returns:
+            List of dictionaries containing image_path, caption and score,
+            best first; only captions sharing a term with the query are returned
+        """
+        self.refresh()
+        terms = Counter(tokenize(query_text))
+        with self._lock:
+            n_docs = len(self.doc_terms)
+            if n_docs == 0 or not terms:
+                return []
+            avg_length = self.total_length / n_docs
+            scores = Counter()
+            for term, query_count in terms.items():
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for image_path, tf in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[image_path] / avg_length)
+                    scores[image_path] += query_count * idf * tf * (self.k1 + 1) / (tf + norm)
+            return [{
+                'image_path': image_path,
+                'caption': self.captions[image_path],
+                'score': score
+            } for image_path, score in scores.most_common(n_results)]
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self.doc_terms)
+
+    def stats(self) -> Dict:
+        """Get index size for /api/stats"""
+        with self._lock:
+            n_docs = len(self.doc_terms)
+            return {
+                'documents': n_docs,
+                'terms': len(self.postings),
+                'avg_caption_terms': round(self.total_length / n_docs, 1) if n_docs else 0.0
+            }
+
+    def _append(self, records: List[Dict]):
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+        with self._file_lock():
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(data)
+            self._refresh_locked()
+            if self._lines - len(self.doc_terms) > max(COMPACT_MIN_DEAD_LINES, len(self.doc_terms)):
+                self._rewrite_locked(list(self.captions.items()))
+
+    def _rewrite_locked(self, items: Iterable[Tuple[str, str]]):
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for image_path, caption in items:
+                f.write(json.dumps({"op": "add", "path": image_path, "caption": caption}, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.path)
+        self._reset()
+        self._refresh_locked()
+
+    @contextmanager
+    def _file_lock(self):
+        """Hold the in-process lock and an exclusive lock on <path>.lock"""
+        with self._lock, exclusive_file_lock(self.path + ".lock"):
+            yield
+
+    def _reset(self):
+        self.postings: Dict[str, Dict[str, int]] = {}  # term -> {image_path: term frequency}
+        self.doc_terms: Dict[str, Counter] = {}  # image_path -> term frequencies
+        self.doc_lengths: Dict[str, int] = {}
+        self.captions: Dict[str, str] = {}
+        self.total_length = 0
+        self._lines = 0  # Log lines replayed, to decide when to compact
+        self._offset = 0
+        self._inode: Optional[int] = None
+
+    def _apply(self, record: Dict):
+        image_path = record["path"]
+        self._remove_doc(image_path)
+        if record["op"] != "add":
+            return
+        terms = Counter(tokenize(record["caption"]))
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[image_path] = tf
+        self.doc_terms[image_path] = terms
+        self.doc_lengths[image_path] = sum(terms.values())
+        self.captions[image_path] = record["caption"]
+        self.total_length += self.doc_lengths[image_path]
+
+    def _remove_doc(self, image_path: str):
+        terms = self.doc_terms.pop(image_path, None)
+        if terms is None:
+            return
+        for term in terms:
+            postings = self.postings[term]
+            postings.pop(image_path, None)
+            if not postings:
+                del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(image_path)
+        self.captions.pop(image_path, None)
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """
+    Fuse several rankings with reciprocal rank fusion
+
+    Args:
+        rankings: Lists of ids, best first
+        k: Damping constant; larger values flatten the contribution of top ranks
+
+    Returns:
+        (id, fused score) pairs, best first
+    """
+    scores = Counter()
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] += 1.0 / (k + rank)
+    return scores.most_common()
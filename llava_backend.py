@@ -9,29 +9,294 @@ import warnings
 from pathlib import Path
 from PIL import Image
 import copy
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 # Add LLaVA-NeXT to path
 LLAVA_PATH = Path(__file__).parent / "LLaVA-NeXT"
 sys.path.insert(0, str(LLAVA_PATH))
 
 from llava.model.builder import load_pretrained_model
-from llava.mm_utils import get_model_name_from_path, process_images, tokenizer_image_token
+from llava.mm_utils import get_model_name_from_path, process_images, tokenizer_image_token, select_best_resolution
 from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN
 from llava.conversation import conv_templates
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from model_manager import IdleEvictingLoader
+import perf_profile
 
 warnings.filterwarnings("ignore")
 
 
+class VisualBudget:
+    """
+    Limit on how many vision tiles (and so visual tokens) an image may use
+    
+    anyres preprocessing splits a large image into a grid of tiles plus a base
+    tile, each costing one vision-tower pass and ~729 visual tokens. Modes:
+    
+    - full: follow the model config's anyres grid (default)
+    - single: one base tile only (fastest; good for bulk ingest)
+    - max_tiles: downscale until the chosen grid has at most max_tiles tiles
+    - max_pixels: downscale to at most max_pixels pixels before tiling
+    - auto: pick per image from its size and max_visual_tokens
+    """
+    
+    MODES = ("full", "single", "max_tiles", "max_pixels", "auto")
+    
+    def __init__(self, mode="full", max_tiles=None, max_pixels=None, max_visual_tokens=None):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown visual budget mode '{mode}', expected one of {self.MODES}")
+        # Without its limit these modes would silently fall back to the full grid
+        if mode == "max_tiles" and not (max_tiles and max_tiles >= 1):
+            raise ValueError("Visual budget mode 'max_tiles' needs max_tiles >= 1")
+        if mode == "max_pixels" and not (max_pixels and max_pixels >= 1):
+            raise ValueError("Visual budget mode 'max_pixels' needs max_pixels >= 1")
+        self.mode = mode
+        self.max_tiles = max_tiles
+        self.max_pixels = max_pixels
+        self.max_visual_tokens = max_visual_tokens
+    
+    @classmethod
+    def coerce(cls, value):
+        """Build a budget from None, a mode name, a dict of arguments or a VisualBudget"""
+        if value is None or isinstance(value, cls):
+            return value
+        if isinstance(value, str):
+            return cls(value)
+        return cls(**value)
+    
+    @classmethod
+    def from_env(cls):
+        """Per-deployment default from LLAVA_VISUAL_BUDGET and its limit variables"""
+        def number(name):
+            value = os.environ.get(name)
+            return int(value) if value else None
+        return cls(
+            os.environ.get("LLAVA_VISUAL_BUDGET", "full"),
+            max_tiles=number("LLAVA_MAX_TILES"),
+            max_pixels=number("LLAVA_MAX_PIXELS"),
+            max_visual_tokens=number("LLAVA_MAX_VISUAL_TOKENS")
+        )
+    
+    def to_dict(self):
+        return {k: v for k, v in vars(self).items() if v is not None}
+
+
+class PolicyStoppingCriteria(StoppingCriteria):
+    """Base class for early-stop rules; records whether it fired"""
+    
+    reason = "stop"
+    
+    def __init__(self):
+        self.triggered = False
+    
+    def __call__(self, input_ids, scores=None, **kwargs):
+        # With inputs_embeds, LLaVA's generate passes only the generated tokens
+        if not self.triggered and self.should_stop(input_ids[0].tolist()):
+            self.triggered = True
+        return torch.full((input_ids.shape[0],), self.triggered, dtype=torch.bool, device=input_ids.device)
+    
+    def should_stop(self, token_ids):
+        raise NotImplementedError
+
+
+class SentenceLimitCriteria(PolicyStoppingCriteria):
+    """Stop once the text contains max_sentences complete sentences"""
+    
+    reason = "sentences"
+    
+    def __init__(self, tokenizer, max_sentences):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.max_sentences = max_sentences
+    
+    def should_stop(self, token_ids):
+        text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+        return len(re.findall(r"[.!?](?=\s|$)", text)) >= self.max_sentences
+
+
+class RepetitionCriteria(PolicyStoppingCriteria):
+    """Stop when the latest n-gram has already appeared max_repeats times (a decoding loop)"""
+    
+    reason = "repetition"
+    
+    def __init__(self, ngram, max_repeats):
+        super().__init__()
+        self.ngram = ngram
+        self.max_repeats = max_repeats
+    
+    def should_stop(self, token_ids):
+        n = self.ngram
+        if len(token_ids) < n * self.max_repeats:
+            return False
+        tail = token_ids[-n:]
+        repeats = sum(1 for i in range(len(token_ids) - n + 1) if token_ids[i:i + n] == tail)
+        return repeats >= self.max_repeats
+
+
+class EmbedderTokenLimitCriteria(PolicyStoppingCriteria):
+    """Stop once the text fills the embedding model's input; anything longer is truncated anyway"""
+    
+    reason = "embedder_limit"
+    
+    def __init__(self, tokenizer, limit, check_every=8):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.limit = limit
+        self.check_every = check_every
+        self.embedder_tokenizer = None
+        try:
+            import vector_db
+            self.embedder_tokenizer = vector_db.get_embedding_model().tokenizer
+        except Exception:
+            pass  # Fall back to counting LLaVA tokens
+    
+    def should_stop(self, token_ids):
+        if len(token_ids) % self.check_every:
+            return False
+        if self.embedder_tokenizer is None:
+            return len(token_ids) >= self.limit
+        text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+        return len(self.embedder_tokenizer(text, add_special_tokens=False)["input_ids"]) >= self.limit
+
+
+class GenerationPolicy:
+    """Token budget, decoding mode and early-stop rules for one kind of request"""
+    
+    def __init__(self, name, max_new_tokens, do_sample=False, temperature=0.0, prompt=None,
+                 max_sentences=None, repetition_ngram=None, max_ngram_repeats=3, embedder_token_limit=None):
+        """
+        Args:
+            name: Policy name used in requests and stats
+            max_new_tokens: Hard cap on generated tokens
+            do_sample: Sample (True) or decode greedily (False)
+            temperature: Sampling temperature
+            prompt: Default prompt for captioning with this policy
+            max_sentences: Stop after this many sentences
+            repetition_ngram: Stop when an n-gram of this size repeats max_ngram_repeats times
+            max_ngram_repeats: See repetition_ngram
+            embedder_token_limit: Stop once the text fills this many embedder tokens
+        """
+        self.name = name
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.prompt = prompt
+        self.max_sentences = max_sentences
+        self.repetition_ngram = repetition_ngram
+        self.max_ngram_repeats = max_ngram_repeats
+        self.embedder_token_limit = embedder_token_limit
+    
+    def stopping_criteria(self, tokenizer):
+        """Fresh criteria for one generation call"""
+        criteria = []
+        if self.max_sentences:
+            criteria.append(SentenceLimitCriteria(tokenizer, self.max_sentences))
+        if self.repetition_ngram:
+            criteria.append(RepetitionCriteria(self.repetition_ngram, self.max_ngram_repeats))
+        if self.embedder_token_limit:
+            criteria.append(EmbedderTokenLimitCriteria(tokenizer, self.embedder_token_limit))
+        return criteria
+
+
+# all-MiniLM-L6-v2 truncates input at 256 word pieces, so longer captions are never indexed
+GENERATION_POLICIES = {
+    "caption": GenerationPolicy(
+        "caption", max_new_tokens=320, prompt="Describe this image in detail.",
+        max_sentences=10, repetition_ngram=4, embedder_token_limit=256
+    ),
+    "short-tag": GenerationPolicy(
+        "short-tag", max_new_tokens=48,
+        prompt="Describe the main subject and objects in this image in one short sentence.",
+        max_sentences=1, repetition_ngram=3
+    ),
+    "chat": GenerationPolicy(
+        "chat", max_new_tokens=1024, do_sample=True, temperature=0.2,
+        repetition_ngram=8, max_ngram_repeats=4
+    ),
+}
+
+
+def get_policy(policy):
+    """Look up a policy by name (or pass a GenerationPolicy through)"""
+    if isinstance(policy, GenerationPolicy):
+        return policy
+    if policy not in GENERATION_POLICIES:
+        raise ValueError(f"Unknown generation policy '{policy}', expected one of {list(GENERATION_POLICIES)}")
+    return GENERATION_POLICIES[policy]
+
+
+def get_caption_policy(policy):
+    """Look up a policy for captioning; it must have a prompt (ValueError otherwise)"""
+    policy = get_policy(policy)
+    if not policy.prompt:
+        captioning = [name for name, p in GENERATION_POLICIES.items() if p.prompt]
+        raise ValueError(f"Policy '{policy.name}' has no caption prompt; use one of {captioning}")
+    return policy
+
+
+# Per-policy generation statistics
+_policy_stats = {}
+_policy_stats_lock = threading.Lock()
+
+
+def _record_generation(policy, criteria, generated_tokens, seconds):
+    fired = [c.reason for c in criteria if c.triggered]
+    if fired:
+        reason = fired[0]
+    elif generated_tokens >= policy.max_new_tokens:
+        reason = "max_tokens"
+    else:
+        reason = "eos"
+    with _policy_stats_lock:
+        stats = _policy_stats.setdefault(policy.name, {
+            'calls': 0, 'generated_tokens': 0, 'seconds': 0.0, 'stop_reasons': Counter()
+        })
+        stats['calls'] += 1
+        stats['generated_tokens'] += generated_tokens
+        stats['seconds'] += seconds
+        stats['stop_reasons'][reason] += 1
+
+
+def generation_stats():
+    """
+    Get per-policy generated-token and latency statistics
+    
+    Returns:
+        Dictionary keyed by policy name
+    """
+    with _policy_stats_lock:
+        return {
+            name: {
+                'calls': s['calls'],
+                'generated_tokens': s['generated_tokens'],
+                'mean_generated_tokens': round(s['generated_tokens'] / s['calls'], 1),
+                'mean_seconds': round(s['seconds'] / s['calls'], 3),
+                'tokens_per_second': round(s['generated_tokens'] / s['seconds'], 1) if s['seconds'] else None,
+                'stop_reasons': dict(s['stop_reasons'])
+            }
+            for name, s in _policy_stats.items()
+        }
+
+
 class LLaVABackend:
     """Backend for LLaVA One Vision model"""
     
-    def __init__(self, model_path="lmms-lab/llava-onevision-qwen2-0.5b-si", device=None):
+    def __init__(self, model_path="lmms-lab/llava-onevision-qwen2-0.5b-si", device=None, torch_dtype=None):
         """
         Initialize the LLaVA model
         
+        Defaults not given here come from the performance profile written by
+        ``python verify_setup.py --profile``, if one exists.
+        
         Args:
             model_path: HuggingFace model ID or local path
             device: Device to run on ('cuda' or 'cpu'). Auto-detects if None.
+            torch_dtype: 'float16', 'bfloat16' or 'float32'. Uses the profile (or float16) if None.
         """
         self.model_path = model_path
         self.model_name = "llava_qwen"
@@ -44,63 +309,186 @@ class LLaVABackend:
             #Sets the variable device to device passes in as variable.
             self.device = device
         
+        self.visual_budget = VisualBudget.from_env()
+        self.torch_dtype = torch_dtype or perf_profile.get("llava_dtype", "float16")
+        self.decode_threads = perf_profile.get("decode_threads", 1)
+        
         print(f"Loading LLaVA One Vision model on {self.device}...")
         print(f"Model: {model_path}")
         
-        # Load model (disable flash attention for compatibility)
-        self.tokenizer, self.model, self.image_processor, self.max_length = load_pretrained_model(
-            self.model_path,
-            None,
-            self.model_name,
+        # Load model (disable flash attention for compatibility). The builder passes
+        # low_cpu_mem_usage=True, so weights are read without an extra randomly
+        # initialized copy. They are cast to torch_dtype as they load, so the model
+        # owns its tensors rather than memory-mapping the checkpoint; a warm reload
+        # is fast because the files are still in the OS page cache.
+        load_kwargs = dict(
             attn_implementation=None,
             device_map="auto" if self.device == "cuda" else self.device
         )
+        # The builder only understands the half-precision dtypes; float32 is converted after loading
+        if self.torch_dtype in ("float16", "bfloat16"):
+            load_kwargs["torch_dtype"] = self.torch_dtype
+        self.tokenizer, self.model, self.image_processor, self.max_length = load_pretrained_model(
+            self.model_path, None, self.model_name, **load_kwargs
+        )
         
+        if self.torch_dtype == "float32":
+            self.model.float()
         self.model.eval()
+        
+        # Set after loading so no thread pool starts before a possible fork (see serve.py)
+        torch_threads = perf_profile.get("torch_threads")
+        if torch_threads and self.device == "cpu":
+            torch.set_num_threads(torch_threads)
         print("Model loaded successfully!")
     
-    def process_images_for_model(self, image_paths):
+    def _tile_size(self):
+        """Side length of one vision tile (the vision tower's input size)"""
+        size = getattr(self.image_processor, "size", 384)
+        if isinstance(size, dict):
+            return size.get("height") or size.get("shortest_edge") or 384
+        if isinstance(size, (tuple, list)):
+            return size[0]
+        return size
+    
+    def _grid_pinpoints(self):
+        """Candidate anyres resolutions from the model config, as [width, height] pairs"""
+        pinpoints = self.model.config.image_grid_pinpoints
+        if isinstance(pinpoints, str) and "x" in pinpoints:
+            # Range form, e.g. "(1x1),...,(6x6)" in tiles
+            matches = re.findall(r"\((\d+)x(\d+)\)", pinpoints)
+            start, end = tuple(map(int, matches[0])), tuple(map(int, matches[-1]))
+            tile = self._tile_size()
+            return [[i * tile, j * tile]
+                    for i in range(start[0], end[0] + 1) for j in range(start[1], end[1] + 1)]
+        if isinstance(pinpoints, str):
+            import ast
+            return ast.literal_eval(pinpoints)
+        return pinpoints
+    
+    def _grid_tiles(self, size):
+        """Number of tiles (grid plus base tile) anyres would use for an image size"""
+        width, height = select_best_resolution(size, self._grid_pinpoints())
+        tile = self._tile_size()
+        return (width // tile) * (height // tile) + 1
+    
+    def _plan_image(self, image, budget):
+        """
+        Apply a visual budget to one image
+        
+        Returns:
+            Tuple of (possibly downscaled image, use_single_crop, tiles)
+        """
+        if budget.mode == "single":
+            return image, True, 1
+        
+        tokens_per_tile = getattr(self.model.get_vision_tower(), "num_patches", 729)
+        max_tiles = budget.max_tiles
+        if budget.mode == "auto":
+            tile = self._tile_size()
+            # Images no bigger than one tile gain nothing from a grid
+            if image.size[0] * image.size[1] <= tile * tile:
+                return image, True, 1
+            if budget.max_visual_tokens:
+                max_tiles = budget.max_visual_tokens // tokens_per_tile
+                if max_tiles < 2:
+                    return image, True, 1
+        
+        if budget.max_pixels and image.size[0] * image.size[1] > budget.max_pixels:
+            scale = (budget.max_pixels / (image.size[0] * image.size[1])) ** 0.5
+            image = image.resize((max(1, int(image.size[0] * scale)), max(1, int(image.size[1] * scale))),
+                                 Image.BICUBIC)
+        
+        tiles = self._grid_tiles(image.size)
+        if max_tiles:
+            # Shrink until anyres picks a small enough grid (the model recomputes the
+            # grid from the image size, so resizing keeps preprocessing and model in sync)
+            while tiles > max_tiles and min(image.size) > self._tile_size() // 2:
+                image = image.resize((int(image.size[0] * 0.8), int(image.size[1] * 0.8)), Image.BICUBIC)
+                tiles = self._grid_tiles(image.size)
+            if tiles > max_tiles:
+                return image, True, 1
+        return image, False, tiles
+    
+    def estimate_visual_tokens(self, image_paths, visual_budget=None):
+        """
+        Estimate vision tiles and visual tokens for images under a budget
+        
+        Token counts are upper bounds: anyres unpadding and the model's own
+        anyres_max pooling can reduce them further.
+        
+        Returns:
+            Dictionary with tiles and approx_visual_tokens
+        """
+        budget = VisualBudget.coerce(visual_budget) or self.visual_budget
+        tokens_per_tile = getattr(self.model.get_vision_tower(), "num_patches", 729)
+        tiles = 0
+        for img_path in image_paths:
+            with Image.open(img_path) as image:
+                if budget.mode == "full":
+                    tiles += self._grid_tiles(image.size)
+                else:
+                    tiles += self._plan_image(image.convert('RGB'), budget)[2]
+        return {'tiles': tiles, 'approx_visual_tokens': tiles * tokens_per_tile}
+    
+    def process_images_for_model(self, image_paths, visual_budget=None):
         """
         Process multiple images for the model
         
         Args:
             image_paths: List of paths to images
+            visual_budget: VisualBudget (or mode name / dict) for this request;
+                defaults to the deployment budget (LLAVA_VISUAL_BUDGET)
             
         Returns:
             Tuple of (image_tensors, image_sizes)
         """
-        images = []
-        for img_path in image_paths:
+        budget = VisualBudget.coerce(visual_budget) or self.visual_budget
+        def load_image(img_path):
             try:
-                image = Image.open(img_path).convert('RGB')
-                images.append(image)
+                return Image.open(img_path).convert('RGB')
             except Exception as e:
                 print(f"Error loading image {img_path}: {e}")
-                continue
+                return None
+        
+        # Decode in parallel when several images arrive together (PIL releases the GIL)
+        if self.decode_threads > 1 and len(image_paths) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.decode_threads, len(image_paths))) as pool:
+                loaded = list(pool.map(load_image, image_paths))
+        else:
+            loaded = [load_image(img_path) for img_path in image_paths]
+        images = [image for image in loaded if image is not None]
         
         if not images:
             return None, None
         
         # Process images
-        image_tensors = process_images(images, self.image_processor, self.model.config)
-        
-        # Move to device with appropriate dtype
-        if self.device == "cuda":
-            image_tensors = [
-                _image.to(dtype=torch.float16, device=self.device) 
-                for _image in image_tensors
-            ]
+        anyres = "anyres" in str(getattr(self.model.config, "image_aspect_ratio", ""))
+        if budget.mode == "full" or not anyres:
+            image_tensors = process_images(images, self.image_processor, self.model.config)
         else:
-            image_tensors = [
-                _image.to(device=self.device) 
-                for _image in image_tensors
-            ]
+            image_tensors = []
+            for index, image in enumerate(images):
+                image, single_crop, _ = self._plan_image(image, budget)
+                images[index] = image
+                if single_crop:
+                    # One base tile; the model treats a 1-tile image as a single crop
+                    image_tensors.append(self.image_processor.preprocess(image, return_tensors="pt")["pixel_values"])
+                else:
+                    image_tensors.append(process_images([image], self.image_processor, self.model.config)[0])
+        
+        # Move to device with the model's dtype
+        image_tensors = [
+            _image.to(dtype=self.model.dtype, device=self.device) 
+            for _image in image_tensors
+        ]
         
         image_sizes = [img.size for img in images]
         
         return image_tensors, image_sizes
     
-    def generate_response(self, prompt, image_paths=None, max_new_tokens=2048, temperature=0.2, do_sample=True):
+    def generate_response(self, prompt, image_paths=None, max_new_tokens=2048, temperature=0.2, do_sample=True,
+                          visual_budget=None, policy=None):
         """
         Generate a response from the model
         
@@ -110,6 +498,9 @@ class LLaVABackend:
             max_new_tokens: Maximum tokens to generate
             temperature: Sampling temperature
             do_sample: Whether to use sampling
+            visual_budget: Optional VisualBudget for the images in this request
+            policy: Optional GenerationPolicy (or name); overrides the three
+                decoding arguments above and adds its early-stop rules
             
         Returns:
             Generated text response
@@ -122,7 +513,7 @@ class LLaVABackend:
             question = f"{image_tokens}\n{prompt}"
             
             # Process images
-            image_tensors, image_sizes = self.process_images_for_model(image_paths)
+            image_tensors, image_sizes = self.process_images_for_model(image_paths, visual_budget)
             
             if image_tensors is None:
                 return "Error: Could not process images!"
@@ -145,7 +536,17 @@ class LLaVABackend:
             return_tensors="pt"
         ).unsqueeze(0).to(self.device)
         
+        criteria = []
+        generate_kwargs = {}
+        if policy is not None:
+            policy = get_policy(policy)
+            max_new_tokens, temperature, do_sample = policy.max_new_tokens, policy.temperature, policy.do_sample
+            criteria = policy.stopping_criteria(self.tokenizer)
+            if criteria:
+                generate_kwargs["stopping_criteria"] = StoppingCriteriaList(criteria)
+        
         # Generate the response
+        start = time.perf_counter()
         with torch.inference_mode():
             output_ids = self.model.generate(
                 input_ids,
@@ -155,37 +556,234 @@ class LLaVABackend:
                 temperature=temperature if do_sample else 0,
                 max_new_tokens=max_new_tokens,
                 use_cache=True,
+                **generate_kwargs
             )
+        if policy is not None:
+            _record_generation(policy, criteria, output_ids.shape[1], time.perf_counter() - start)
         
         # Decode output
         outputs = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
         
         return outputs
     
-    def chat(self, prompt, image_paths=None):
+    def _embed_segment(self, text, images=None, image_sizes=None):
+        """
+        Tokenize a prompt segment and turn it into input embeddings
+
+        Image tokens in the segment are expanded into vision features, so a
+        segment can be prefilled on top of an existing KV cache.
+
+        Args:
+            text: Prompt text (may contain image tokens)
+            images: Image tensors for the image tokens in this segment
+            image_sizes: Original sizes of those images
+
+        Returns:
+            Tensor of input embeddings with shape (1, seq_len, hidden)
+        """
+        input_ids = tokenizer_image_token(
+            text,
+            self.tokenizer,
+            IMAGE_TOKEN_INDEX,
+            return_tensors="pt"
+        ).unsqueeze(0).to(self.device)
+        
+        if images:
+            _, _, _, _, inputs_embeds, _ = self.model.prepare_inputs_labels_for_multimodal(
+                input_ids, None, None, None, None, images, image_sizes=image_sizes
+            )
+            return inputs_embeds
+        return self.model.get_model().embed_tokens(input_ids)
+    
+    def _decode_with_cache(self, inputs_embeds, past_key_values, max_new_tokens, temperature, do_sample,
+                           stop_token_ids, criteria=()):
+        """
+        Prefill the given embeddings on top of a KV cache and decode a reply
+
+        Returns:
+            Tuple of (generated_token_ids, past_key_values). Every generated token
+            except a trailing stop token is already in the returned cache.
+        """
+        generated = []
+        
+        with torch.inference_mode():
+            outputs = self.model(
+                inputs_embeds=inputs_embeds,
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True,
+            )
+            past_key_values = outputs.past_key_values
+            
+            for _ in range(max_new_tokens):
+                logits = outputs.logits[:, -1, :].float()
+                
+                if do_sample and temperature > 0:
+                    probs = torch.softmax(logits / temperature, dim=-1)
+                    next_token = torch.multinomial(probs, num_samples=1)
+                else:
+                    next_token = torch.argmax(logits, dim=-1, keepdim=True)
+                
+                token_id = next_token.item()
+                generated.append(token_id)
+                if token_id in stop_token_ids:
+                    break
+                
+                outputs = self.model(
+                    inputs_embeds=self.model.get_model().embed_tokens(next_token),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    return_dict=True,
+                )
+                past_key_values = outputs.past_key_values
+                
+                # Checked after feeding the token so the cache covers the whole reply
+                if criteria:
+                    generated_ids = torch.tensor([generated], device=next_token.device)
+                    if any(bool(c(generated_ids)[0]) for c in criteria):
+                        break
+        
+        return generated, past_key_values
+    
+    def chat_turn(self, session, prompt, image_paths=None, policy="chat"):
+        """
+        Run one turn of a stateful conversation
+        
+        Only the tokens added since the previous turn (the new user message and
+        any images not yet seen by the session) are prefilled; everything before
+        them is reused from the session's KV cache.
+        
+        Args:
+            session: chat_sessions.ChatSession holding history and KV cache
+            prompt: New user message
+            image_paths: Images for this turn; ones already in the session are skipped
+            policy: GenerationPolicy (or name) for token budget, decoding and early stops
+            
+        Returns:
+            Dictionary with the response and prefill statistics
+        """
+        policy = get_policy(policy)
+        max_new_tokens = policy.max_new_tokens
+        new_image_paths = [p for p in (image_paths or []) if p not in session.image_paths]
+        if new_image_paths:
+            question = f"{DEFAULT_IMAGE_TOKEN * len(new_image_paths)}\n{prompt}"
+        else:
+            question = prompt
+        
+        # Rebuild the prompt text from the template; the cache covers a prefix of it
+        conv = copy.deepcopy(conv_templates[self.conv_template])
+        for role, message in session.messages:
+            conv.append_message(role, message)
+        conv.append_message(conv.roles[0], question)
+        conv.append_message(conv.roles[1], None)
+        full_prompt = conv.get_prompt()
+        
+        if session.past_key_values is not None and full_prompt.startswith(session.cached_text):
+            segment = full_prompt[len(session.cached_text):]
+            segment_paths = new_image_paths
+        else:
+            # Cache missing or evicted: re-prefill the whole conversation
+            session.reset_cache()
+            segment = full_prompt
+            segment_paths = session.image_paths + new_image_paths
+        
+        # Each image is encoded once, only for the segment that is prefilled
+        segment_images, segment_sizes = None, None
+        if segment_paths:
+            segment_images, segment_sizes = self.process_images_for_model(segment_paths)
+            if segment_images is None or len(segment_images) != len(segment_paths):
+                raise ValueError("Could not process images")
+        
+        inputs_embeds = self._embed_segment(segment, segment_images, segment_sizes)
+        prefill_tokens = inputs_embeds.shape[1]
+        if session.cached_tokens + prefill_tokens + max_new_tokens > self.max_length:
+            raise ValueError("Conversation is too long for the model context; start a new session")
+        
+        stop_token_ids = {self.tokenizer.eos_token_id}
+        sep_id = self.tokenizer.convert_tokens_to_ids(conv.sep) if conv.sep else None
+        if sep_id is not None and sep_id != self.tokenizer.unk_token_id:
+            stop_token_ids.add(sep_id)
+        
+        criteria = policy.stopping_criteria(self.tokenizer)
+        start = time.perf_counter()
+        output_ids, past_key_values = self._decode_with_cache(
+            inputs_embeds, session.past_key_values, max_new_tokens, policy.temperature, policy.do_sample,
+            stop_token_ids, criteria
+        )
+        _record_generation(policy, criteria, len(output_ids), time.perf_counter() - start)
+        
+        # A trailing stop token is not in the cache; the next segment re-adds the separator
+        cached_ids = output_ids[:-1] if output_ids and output_ids[-1] in stop_token_ids else output_ids
+        response_text = self.tokenizer.decode(cached_ids, skip_special_tokens=True)
+        
+        session.messages.append((conv.roles[0], question))
+        session.messages.append((conv.roles[1], response_text))
+        session.image_paths.extend(new_image_paths)
+        session.turns += 1
+        session.past_key_values = past_key_values
+        session.cached_text = full_prompt + response_text
+        session.cached_tokens += prefill_tokens + len(cached_ids)
+        
+        return {
+            'response': response_text.strip(),
+            'prefill_tokens': prefill_tokens,
+            'generated_tokens': len(output_ids),
+            'cached_tokens': session.cached_tokens
+        }
+    
+    def caption(self, image_path, policy="caption", visual_budget=None):
+        """
+        Caption one image for indexing
+        
+        Args:
+            image_path: Path to the image
+            policy: GenerationPolicy (or name) supplying the prompt, token budget and early stops;
+                it must have a prompt (ValueError otherwise)
+            visual_budget: Optional VisualBudget (or mode name) for the image
+            
+        Returns:
+            Caption text
+        """
+        policy = get_caption_policy(policy)
+        return self.generate_response(policy.prompt, [image_path], visual_budget=visual_budget, policy=policy)
+    
+    def chat(self, prompt, image_paths=None, visual_budget=None):
         """
         Simple chat interface
         
         Args:
             prompt: User question/prompt
             image_paths: Optional list of image file paths
+            visual_budget: Optional VisualBudget (or mode name) for the images
             
         Returns:
             Model response
         """
-        return self.generate_response(prompt, image_paths)
+        return self.generate_response(prompt, image_paths, visual_budget=visual_budget)
 
 
-# Global model instance (lazy loaded)
-_model_instance = None
+# Global model instance (lazy loaded). Set LLAVA_IDLE_UNLOAD_SECONDS to free it
+# after that many idle seconds; it is reloaded on the next request.
+_model_loader = IdleEvictingLoader(
+    "llava",
+    LLaVABackend,
+    idle_seconds=float(os.environ.get("LLAVA_IDLE_UNLOAD_SECONDS", "0"))
+)
 
 
 def get_model():
     """Get or create the global model instance"""
-    global _model_instance
-    if _model_instance is None:
-        _model_instance = LLaVABackend()
-    return _model_instance
+    return _model_loader.get()
+
+
+def use_model():
+    """Context manager yielding the global model; it is not evicted while in use"""
+    return _model_loader.acquire()
+
+
+def unload_model():
+    """Free the global model now (if no request is using it)"""
+    return _model_loader.unload()
 
 
 def chat(prompt, image_paths=None):
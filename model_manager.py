@@ -0,0 +1,168 @@
+"""
+Model Manager
+Loads models on demand and frees them again after a configurable idle period,
+recording load/unload events and timings
+"""
+import ctypes
+import gc
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+# All loaders created in this process, for status reporting
+_loaders: List["IdleEvictingLoader"] = []
+
+
+def free_memory():
+    """Return freed model memory to the OS (and the GPU allocator, if torch is loaded)"""
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    if sys.platform.startswith("linux"):
+        try:
+            # glibc keeps freed heap pages unless asked to give them back
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+
+class IdleEvictingLoader:
+    """Holds one lazily-loaded model and evicts it after an idle period"""
+
+    def __init__(self, name: str, load_fn: Callable, idle_seconds: float = 0, check_interval: float = 30):
+        """
+        Initialize the loader
+
+        Args:
+            name: Name used in logs and status reports
+            load_fn: Callable that loads and returns the model
+            idle_seconds: Unload after this many idle seconds (0 disables eviction)
+            check_interval: How often the background thread checks for idleness
+        """
+        self.name = name
+        self.load_fn = load_fn
+        self.idle_seconds = idle_seconds
+        self.check_interval = min(check_interval, idle_seconds) if idle_seconds > 0 else check_interval
+
+        self._instance = None
+        self._lock = threading.RLock()
+        self._active = 0
+        self._last_used = time.time()
+        self._evictor_pid = None  # Process the evictor thread runs in
+
+        self.loads = 0
+        self.unloads = 0
+        self.last_load_seconds = None
+        self.total_load_seconds = 0.0
+        self.events = deque(maxlen=50)
+
+        _loaders.append(self)
+
+    def get(self):
+        """Get the model, loading it if needed"""
+        with self._lock:
+            self._last_used = time.time()
+            if self._instance is None:
+                self._load()
+            self._ensure_evictor()
+            return self._instance
+
+    @contextmanager
+    def acquire(self):
+        """Context manager that keeps the model from being evicted while in use"""
+        with self._lock:
+            model = self.get()
+            self._active += 1
+        try:
+            yield model
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._last_used = time.time()
+
+    def is_loaded(self) -> bool:
+        return self._instance is not None
+
+    def unload(self, reason: str = "manual") -> bool:
+        """
+        Drop the model and free its memory
+
+        Returns:
+            True if a model was unloaded
+        """
+        with self._lock:
+            if self._instance is None or self._active > 0:
+                return False
+            self._instance = None
+            self.unloads += 1
+            idle = time.time() - self._last_used
+        free_memory()
+        self._record("unload", reason=reason, idle_seconds=round(idle, 1))
+        print(f"Unloaded {self.name} model ({reason}, idle {idle:.0f}s)")
+        return True
+
+    def maybe_evict(self) -> bool:
+        """Unload the model if it has been idle for longer than idle_seconds"""
+        if self.idle_seconds <= 0:
+            return False
+        with self._lock:
+            if self._instance is None or self._active > 0:
+                return False
+            if time.time() - self._last_used < self.idle_seconds:
+                return False
+            return self.unload(reason="idle")
+
+    def stats(self) -> Dict:
+        """Get load/unload counters, timings and recent events"""
+        with self._lock:
+            return {
+                'name': self.name,
+                'loaded': self._instance is not None,
+                'active': self._active,
+                'idle_seconds': round(time.time() - self._last_used, 1),
+                'evict_after_seconds': self.idle_seconds,
+                'loads': self.loads,
+                'unloads': self.unloads,
+                'last_load_seconds': self.last_load_seconds,
+                'total_load_seconds': round(self.total_load_seconds, 3),
+                'events': list(self.events)
+            }
+
+    def _load(self):
+        start = time.perf_counter()
+        self._instance = self.load_fn()
+        elapsed = time.perf_counter() - start
+
+        self.loads += 1
+        self.last_load_seconds = round(elapsed, 3)
+        self.total_load_seconds += elapsed
+        self._record("load", seconds=self.last_load_seconds, cold=self.loads == 1)
+        print(f"Loaded {self.name} model in {elapsed:.1f}s")
+
+    def _ensure_evictor(self):
+        # Threads do not survive fork(): a worker forked from a master that loaded
+        # the model (serve.py) must start its own evictor
+        if self.idle_seconds > 0 and self._evictor_pid != os.getpid():
+            self._evictor_pid = os.getpid()
+            threading.Thread(target=self._evict_loop, name=f"{self.name}-evictor", daemon=True).start()
+
+    def _evict_loop(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.maybe_evict()
+            except Exception as e:
+                print(f"Error evicting {self.name} model: {e}")
+
+    def _record(self, event: str, **details):
+        self.events.append({'event': event, 'time': time.time(), **details})
+
+
+def all_stats() -> List[Dict]:
+    """Get the status of every model loader in this process"""
+    return [loader.stats() for loader in _loaders]
@@ -0,0 +1,63 @@
+"""
+Performance Profile
+Loads the per-node tuning profile written by ``python verify_setup.py --profile``
+so the LLaVA backend (decode threads, torch threads, dtype) and chat sessions
+(KV-cache budget) start with settings measured on this machine
+"""
+import json
+import os
+from typing import Any, Dict, Optional
+
+# Override with LLAVA_PERF_PROFILE to keep profiles outside the project directory
+PROFILE_PATH = os.environ.get("LLAVA_PERF_PROFILE", "performance_profile.json")
+
+_profile = None
+
+
+def load_profile(path: Optional[str] = None) -> Dict:
+    """
+    Load the performance profile (cached after the first call)
+
+    Args:
+        path: Profile file; defaults to PROFILE_PATH
+
+    Returns:
+        Profile dictionary, or an empty one if no profile has been written
+    """
+    global _profile
+    if _profile is not None and path is None:
+        return _profile
+
+    profile = {}
+    profile_path = path or PROFILE_PATH
+    if os.path.exists(profile_path):
+        try:
+            with open(profile_path, encoding="utf-8") as f:
+                profile = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable performance profile {profile_path}: {e}")
+
+    if path is None:
+        _profile = profile
+    return profile
+
+
+def get(key: str, default: Any = None) -> Any:
+    """Get one tuned setting, falling back to the default when it was not measured"""
+    value = load_profile().get("settings", {}).get(key)
+    return default if value is None else value
+
+
+def save_profile(profile: Dict, path: Optional[str] = None):
+    """
+    Write a profile and make it the one returned by load_profile
+
+    Args:
+        profile: Profile dictionary with a "settings" section
+        path: Profile file; defaults to PROFILE_PATH
+    """
+    global _profile
+    with open(path or PROFILE_PATH, "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=2)
+    if path is None:
+        _profile = profile
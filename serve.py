@@ -0,0 +1,214 @@
+"""
+Production Server for LLaVA Image Search
+Runs the Flask app under gunicorn with the models loaded once in the master
+process, so forked workers share the weights copy-on-write
+
+Usage:
+    # Captioning + chat + search (one worker keeps chat sessions in one place)
+    python serve.py --role full --port 5000 --workers 1 --threads 4
+
+    # Read-only search replicas (uploads, indexing and chat are rejected);
+    # several processes need a shared Chroma server
+    chroma run --path ./chroma_db --port 8000
+    LLAVA_CHROMA_HOST=localhost python serve.py --role search --port 5001 --workers 4 --threads 8
+
+Send SIGHUP to the master for a graceful restart: workers are re-forked from
+the master, which still holds the weights, so nothing is reloaded from disk.
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+# Query CUDA through NVML so the check does not create a context before fork
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    print("gunicorn is required for serve.py (not available on Windows).")
+    print("Install it with: pip install gunicorn")
+    print("On Windows, use: python app.py")
+    sys.exit(1)
+
+
+def cuda_available():
+    """Check for CUDA without initializing it in this process"""
+    import torch
+    return torch.cuda.is_available()
+
+
+def bootstrap_index(role):
+    """
+    Start importing LLAVA_BOOTSTRAP_SNAPSHOT into an empty collection, before any worker starts
+
+    The import runs in one subprocess, so no worker races another over the
+    collection and no ChromaDB client is inherited across fork(). Workers are
+    started once it serves reads: until the bulk load finishes they answer
+    searches from the memory-mapped snapshot and reject uploads (see
+    ImageCaptionVectorDB.import_snapshot). Workers never see the variable,
+    so they do not import again.
+    """
+    path = os.environ.pop("LLAVA_BOOTSTRAP_SNAPSHOT", None)
+    if not path:
+        return
+    if role != "full":
+        print("Ignoring LLAVA_BOOTSTRAP_SNAPSHOT: search replicas do not write the index")
+        return
+    import vector_db
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshot.py")
+    command = [sys.executable, script, "import", path, "--if-empty"]
+    process = subprocess.Popen(command)
+    # gunicorn's arbiter reaps the subprocess when it exits
+    marker_path = os.path.join("./chroma_db", vector_db.BOOTSTRAP_FILE)
+    while process.poll() is None and not import_started(marker_path, process.pid):
+        time.sleep(0.5)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def import_started(marker_path, pid):
+    """Check whether the import subprocess is serving reads from its snapshot"""
+    try:
+        with open(marker_path, encoding="utf-8") as f:
+            return json.load(f).get("pid") == pid
+    except (OSError, ValueError):
+        return False
+
+
+def load_models(app_module, role):
+    """
+    Load the models a worker role needs into the app module's globals
+
+    Args:
+        app_module: The imported ``app`` module
+        role: 'full' (LLaVA + embedder) or 'search' (embedder only)
+    """
+    import vector_db
+    vector_db.get_embedding_model()
+
+    if role == 'full':
+        app_module.get_caption_model()
+
+
+class PreloadedApplication(BaseApplication):
+    """gunicorn application that serves an already-loaded Flask app"""
+
+    def __init__(self, application, options):
+        """
+        Initialize the gunicorn application
+
+        Args:
+            application: WSGI app, built (and its models loaded) in the master
+            options: gunicorn settings
+        """
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Called again on SIGHUP; returning the same object avoids a reload
+        return self.application
+
+
+def parse_args(argv=None):
+    cpu_count = multiprocessing.cpu_count()
+    parser = argparse.ArgumentParser(description="Run LLaVA Image Search with gunicorn")
+    parser.add_argument("--role", choices=["full", "search"], default="full",
+                        help="'full' serves captioning, chat and search; 'search' is read-only")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes (default: 1 for full; CPU count / 2 for search "
+                             "with LLAVA_CHROMA_HOST, otherwise 1)")
+    parser.add_argument("--threads", type=int, default=4, help="Threads per worker")
+    parser.add_argument("--torch-threads", type=int, default=None,
+                        help="torch intra-op threads per worker (default: CPUs / workers)")
+    parser.add_argument("--timeout", type=int, default=600,
+                        help="Worker timeout in seconds (captioning can be slow on CPU)")
+    args = parser.parse_args(argv)
+
+    shared_chroma = bool(os.environ.get("LLAVA_CHROMA_HOST"))
+    if args.workers is None:
+        args.workers = max(1, cpu_count // 2) if args.role == "search" and shared_chroma else 1
+    if args.role == "full" and args.workers > 1:
+        # Chat sessions and their KV caches live in one worker's memory; turns routed
+        # to another worker would silently start a new session
+        print("The full role keeps chat sessions in worker memory: using 1 worker. "
+              "Scale it with --threads, and add search replicas for read traffic.")
+        args.workers = 1
+    if args.workers > 1 and not shared_chroma:
+        # Each process would open its own embedded ChromaDB with a private HNSW index
+        print("The embedded ChromaDB is not multi-process safe: using 1 worker. "
+              "Set LLAVA_CHROMA_HOST to a Chroma server to run more.")
+        args.workers = 1
+    if args.role == "search" and not shared_chroma:
+        print("Warning: without LLAVA_CHROMA_HOST this replica has its own copy of the index and "
+              "does not see images captioned by other processes until it restarts")
+    if args.torch_threads is None:
+        args.torch_threads = max(1, cpu_count // args.workers)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.role == "search":
+        # Read by app.py and vector_db.get_db() on import
+        os.environ["LLAVA_SEARCH_ONLY"] = "1"
+    bootstrap_index(args.role)
+
+    import torch
+    import app as app_module
+
+    if args.role == "search":
+        app_module.app.config['READ_ONLY'] = True
+
+    # A CUDA context cannot cross fork(), so GPU models are loaded per worker
+    share_weights = not cuda_available()
+    if not share_weights and args.role == "full" and args.workers > 1:
+        print("CUDA detected: using 1 worker so the model is loaded on the GPU only once")
+        args.workers = 1
+
+    if share_weights and any(float(os.environ.get(var, "0")) > 0 for var in
+                             ("LLAVA_IDLE_UNLOAD_SECONDS", "LLAVA_EMBEDDER_IDLE_UNLOAD_SECONDS")):
+        print("Warning: idle unloading is on; a worker that unloads a model reloads its own "
+              "copy instead of sharing the master's")
+
+    if share_weights:
+        # Loading single-threaded keeps OpenMP from starting threads that fork() would break
+        torch.set_num_threads(1)
+        load_models(app_module, args.role)
+        # Keep the GC from touching (and so copying) the preloaded objects in workers
+        gc.freeze()
+
+    def post_fork(server, worker):
+        torch.set_num_threads(args.torch_threads)
+        if not share_weights:
+            load_models(app_module, args.role)
+
+    options = {
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": "gthread",
+        "timeout": args.timeout,
+        "graceful_timeout": args.timeout,
+        "post_fork": post_fork,
+    }
+
+    print(f"Serving role '{args.role}' on {options['bind']} with {args.workers} worker(s) x "
+          f"{args.threads} thread(s), {args.torch_threads} torch thread(s) per worker")
+    PreloadedApplication(app_module.app, options).run()
+
+
+if __name__ == '__main__':
+    main()
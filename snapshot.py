@@ -0,0 +1,277 @@
+"""
+Index Snapshots
+Compact export/import of the vector database for fast node bootstrap
+
+A snapshot holds float16 embeddings in one contiguous .npy array (which can be
+memory-mapped), plus ids, captions and metadata in Parquet (or JSON Lines when
+pyarrow is not installed), and a manifest with SHA-256 checksums. A snapshot
+can be a directory or a single uncompressed .tar file.
+
+Usage:
+    python snapshot.py export snapshot.tar
+    python snapshot.py import snapshot.tar
+    python snapshot.py import snapshot.tar --if-empty
+    python snapshot.py verify snapshot.tar
+"""
+import argparse
+import hashlib
+import json
+import os
+import tarfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+EMBEDDINGS_FILE = "embeddings.f16.npy"
+PARQUET_FILE = "records.parquet"
+JSONL_FILE = "records.jsonl"
+
+# Rows scored per step of a NumPy search, to bound float32 scratch memory
+SEARCH_CHUNK = 65536
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot is missing files or fails verification"""
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _import_parquet():
+    # Imported on use: pyarrow is optional and slow to import
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None, None
+    return pa, pq
+
+
+def write_snapshot(path: str, ids: List[str], embeddings, documents: List[str],
+                   metadatas: List[Dict], index_metadata: Optional[Dict] = None) -> Dict:
+    """
+    Write a snapshot
+
+    Args:
+        path: Output directory, or a file ending in .tar
+        ids: Collection ids
+        embeddings: Array-like of shape (n, dim)
+        documents: Stored documents (captions)
+        metadatas: Per-item metadata (must contain image_path and caption)
+        index_metadata: Collection metadata (HNSW parameters), kept for import
+
+    Returns:
+        The manifest
+    """
+    as_tar = path.endswith(".tar")
+    directory = Path(path[:-4] + ".d" if as_tar else path)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    vectors = np.ascontiguousarray(np.asarray(embeddings, dtype=np.float16))
+    np.save(directory / EMBEDDINGS_FILE, vectors)
+
+    records = {
+        "id": list(ids),
+        "document": list(documents),
+        "metadata": [json.dumps(m, ensure_ascii=False) for m in metadatas],
+    }
+    pa, pq = _import_parquet()
+    if pq is not None:
+        records_file = PARQUET_FILE
+        pq.write_table(pa.table(records), directory / records_file, compression="zstd")
+    else:
+        records_file = JSONL_FILE
+        with open(directory / records_file, "w", encoding="utf-8") as f:
+            for i in range(len(records["id"])):
+                f.write(json.dumps({k: v[i] for k, v in records.items()}, ensure_ascii=False) + "\n")
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "count": len(records["id"]),
+        "dim": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+        "index_metadata": index_metadata or {},
+        "files": {
+            name: {"sha256": _sha256(directory / name), "bytes": (directory / name).stat().st_size}
+            for name in (EMBEDDINGS_FILE, records_file)
+        }
+    }
+    with open(directory / MANIFEST_FILE, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    if as_tar:
+        # Uncompressed: float16 embeddings barely compress and extraction stays I/O-bound
+        with tarfile.open(path, "w") as tar:
+            for name in [MANIFEST_FILE] + list(manifest["files"]):
+                tar.add(directory / name, arcname=name)
+    return manifest
+
+
+def open_snapshot(path: str, verify: bool = True) -> Path:
+    """
+    Locate (and for .tar files, extract) a snapshot and check its checksums
+
+    Args:
+        path: Snapshot directory or .tar file
+        verify: Check SHA-256 checksums against the manifest
+
+    Returns:
+        Directory containing the snapshot files
+    """
+    if path.endswith(".tar"):
+        directory = Path(path[:-4] + ".d")
+        manifest_path = directory / MANIFEST_FILE
+        if not manifest_path.exists() or manifest_path.stat().st_mtime < os.path.getmtime(path):
+            directory.mkdir(parents=True, exist_ok=True)
+            with tarfile.open(path, "r") as tar:
+                for member in tar.getmembers():
+                    if not member.isfile() or member.name not in (MANIFEST_FILE, EMBEDDINGS_FILE, PARQUET_FILE, JSONL_FILE):
+                        raise SnapshotError(f"Unexpected file in snapshot: {member.name}")
+                tar.extractall(directory)
+    else:
+        directory = Path(path)
+
+    manifest = read_manifest(directory)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise SnapshotError(f"Unsupported snapshot format {manifest.get('format_version')}")
+    for name, info in manifest["files"].items():
+        if not (directory / name).exists():
+            raise SnapshotError(f"Snapshot is missing {name}")
+        if verify and _sha256(directory / name) != info["sha256"]:
+            raise SnapshotError(f"Checksum mismatch for {name}")
+    return directory
+
+
+def read_manifest(directory: Path) -> Dict:
+    try:
+        with open(directory / MANIFEST_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"Cannot read snapshot manifest: {e}")
+
+
+def read_records(directory: Path) -> Dict[str, List]:
+    """Read ids, documents and metadata (decoded) from a snapshot directory"""
+    if (directory / PARQUET_FILE).exists():
+        _, pq = _import_parquet()
+        if pq is None:
+            raise SnapshotError("This snapshot uses Parquet; install pyarrow to read it")
+        records = pq.read_table(directory / PARQUET_FILE).to_pydict()
+    else:
+        records = {"id": [], "document": [], "metadata": []}
+        with open(directory / JSONL_FILE, encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                for key in records:
+                    records[key].append(row[key])
+    records["metadata"] = [json.loads(m) for m in records["metadata"]]
+    return records
+
+
+def load_embeddings(directory: Path, mmap: bool = True) -> np.ndarray:
+    """Load the float16 embedding matrix, memory-mapped by default"""
+    return np.load(directory / EMBEDDINGS_FILE, mmap_mode="r" if mmap else None)
+
+
+class SnapshotSearchIndex:
+    """Exact NumPy search over memory-mapped snapshot embeddings"""
+
+    def __init__(self, directory: Path):
+        """
+        Open a verified snapshot directory for searching
+
+        Args:
+            directory: Directory returned by open_snapshot
+        """
+        self.directory = directory
+        self.manifest = read_manifest(directory)
+        self.embeddings = load_embeddings(directory, mmap=True)
+        records = read_records(directory)
+        self.ids = records["id"]
+        self.documents = records["document"]
+        self.metadatas = records["metadata"]
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def search(self, query_embedding, n_results: int) -> List[Dict]:
+        """
+        Score every stored embedding against the query (cosine similarity)
+
+        Args:
+            query_embedding: Query vector from the embedding model
+            n_results: Number of results to return
+
+        Returns:
+            Results in the same format as ImageCaptionVectorDB.search
+        """
+        if self.count() == 0:
+            return []
+        query = np.array(query_embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        scores = np.empty(self.count(), dtype=np.float32)
+        for start in range(0, self.count(), SEARCH_CHUNK):
+            chunk = self.embeddings[start:start + SEARCH_CHUNK].astype(np.float32)
+            norms = np.linalg.norm(chunk, axis=1)
+            norms[norms == 0] = 1.0
+            scores[start:start + len(chunk)] = (chunk @ query) / norms
+
+        n = min(n_results, self.count())
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top])]
+        return [{
+            'image_path': self.metadatas[i]['image_path'],
+            'caption': self.metadatas[i]['caption'],
+            'similarity': float(scores[i]),
+            'distance': float(1 - scores[i])
+        } for i in top]
+
+    def get_all(self) -> List[Dict]:
+        return [{'image_path': m['image_path'], 'caption': m['caption']} for m in self.metadatas]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export, import or verify index snapshots")
+    parser.add_argument("command", choices=["export", "import", "verify"])
+    parser.add_argument("path", help="Snapshot directory or .tar file")
+    parser.add_argument("--persist-directory", default="./chroma_db")
+    parser.add_argument("--if-empty", action="store_true",
+                        help="Import only into an empty collection (for bootstrapping new nodes)")
+    args = parser.parse_args(argv)
+
+    if args.command == "verify":
+        directory = open_snapshot(args.path)
+        manifest = read_manifest(directory)
+        print(f"✓ Snapshot OK: {manifest['count']} items, dim {manifest['dim']}")
+        return
+
+    import vector_db
+    db = vector_db.ImageCaptionVectorDB(
+        args.persist_directory,
+        chroma_host=os.environ.get("LLAVA_CHROMA_HOST") or None,
+        chroma_port=int(os.environ.get("LLAVA_CHROMA_PORT", "8000"))
+    )
+    if args.command == "import" and args.if_empty and db.collection.count() > 0:
+        print(f"Collection already has {db.collection.count()} items; skipping import")
+        return
+    start = time.perf_counter()
+    if args.command == "export":
+        manifest = db.export_snapshot(args.path)
+        print(f"✓ Exported {manifest['count']} items to {args.path} in {time.perf_counter() - start:.1f}s")
+    else:
+        count = db.import_snapshot(args.path, background=False)
+        print(f"✓ Imported {count} items from {args.path} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
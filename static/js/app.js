@@ -1,4 +1,5 @@
 let uploadedImages = [];
+let chatSessionId = null;
 
 const dropZone = document.getElementById('dropZone');
 const fileInput = document.getElementById('fileInput');
@@ -44,8 +45,17 @@ clearImageBtn.addEventListener('click', () => {
     uploadedImages = [];
     updateImagePreview();
     fileInput.value = '';
+    resetChatSession();
 });
 
+// End the server-side chat session so its KV cache is freed
+function resetChatSession() {
+    if (chatSessionId) {
+        fetch(`/chat/${chatSessionId}`, { method: 'DELETE' });
+        chatSessionId = null;
+    }
+}
+
 async function uploadMultipleImages(files) {
     for (const file of files) {
         const formData = new FormData();
@@ -123,6 +133,7 @@ function updateImagePreview() {
 function removeImage(index) {
     uploadedImages.splice(index, 1);
     updateImagePreview();
+    resetChatSession();
     if (uploadedImages.length === 0) {
         addMessage('All images cleared.', 'assistant');
     } else {
@@ -183,12 +194,21 @@ async function sendMessage() {
             },
             body: JSON.stringify({
                 prompt: prompt,
-                image_paths: uploadedImages.map(img => img.filename)
+                image_paths: uploadedImages.map(img => img.filename),
+                session_id: chatSessionId
             })
         });
 
         const data = await response.json();
 
+        if (data.session_id) {
+            chatSessionId = data.session_id;
+        }
+
+        if (data.session_reset) {
+            addMessage('The previous conversation expired on the server; the model no longer sees earlier messages.', 'error');
+        }
+
         if (data.success) {
             addMessage(data.response, 'assistant');
         } else {
@@ -0,0 +1,176 @@
+"""
+HNSW Index Tuning Tool for LLaVA Image Search
+Measures recall@k against exact search, and query latency, across a grid of
+HNSW parameters on the embeddings already stored in the vector database
+
+Uses hnswlib, the HNSW library behind Chroma's index, so the numbers carry
+over to the collection. chromadb 1.x no longer installs it; run
+``pip install chroma-hnswlib`` first.
+
+Usage:
+    python tune_index.py
+    python tune_index.py --m 8 16 32 --ef-search 10 50 100 --k 10 --target-recall 0.95
+    python tune_index.py --queries-file queries.txt --json tuning.json
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    raise SystemExit("tune_index.py needs hnswlib, which chromadb 1.x no longer installs. "
+                     "Install it with: pip install chroma-hnswlib")
+
+import vector_db
+
+
+def load_corpus(persist_directory):
+    """
+    Load the stored caption embeddings
+
+    Returns:
+        float32 array of shape (n, dim)
+    """
+    db = vector_db.ImageCaptionVectorDB(persist_directory)
+    data = db.collection.get(include=["embeddings"])
+    return np.asarray(data["embeddings"], dtype=np.float32)
+
+
+def load_queries(args, corpus):
+    """Encode queries from a file, or sample stored embeddings as queries"""
+    if args.queries_file:
+        with open(args.queries_file, encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+        model = vector_db.get_embedding_model()
+        return np.asarray(model.encode(texts), dtype=np.float32)
+
+    rng = np.random.default_rng(args.seed)
+    idx = rng.choice(len(corpus), size=min(args.n_queries, len(corpus)), replace=False)
+    return corpus[idx]
+
+
+def exact_top_k(corpus, queries, k, space):
+    """
+    Brute-force nearest neighbours, the ground truth for recall
+
+    Returns:
+        int array of shape (n_queries, k) with corpus indices
+    """
+    if space == "cosine":
+        corpus = corpus / np.linalg.norm(corpus, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    if space == "l2":
+        scores = -(np.sum(queries ** 2, axis=1, keepdims=True)
+                   - 2 * queries @ corpus.T
+                   + np.sum(corpus ** 2, axis=1))
+    else:
+        scores = queries @ corpus.T
+
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def evaluate(corpus, queries, truth, k, space, m, ef_construction, ef_search_values, threads):
+    """
+    Build one HNSW index and measure recall and latency for each ef_search
+
+    Returns:
+        List of result dictionaries, one per ef_search value
+    """
+    start = time.perf_counter()
+    index = hnswlib.Index(space=space, dim=corpus.shape[1])
+    index.init_index(max_elements=len(corpus), ef_construction=ef_construction, M=m)
+    index.add_items(corpus, np.arange(len(corpus)), num_threads=threads)
+    build_seconds = time.perf_counter() - start
+
+    results = []
+    for ef_search in ef_search_values:
+        index.set_ef(max(ef_search, k))
+        latencies = []
+        hits = 0
+        for query, expected in zip(queries, truth):
+            t0 = time.perf_counter()
+            labels, _ = index.knn_query(query, k=k)
+            latencies.append(time.perf_counter() - t0)
+            hits += len(set(labels[0].tolist()) & set(expected.tolist()))
+
+        latencies_ms = np.array(latencies) * 1000
+        results.append({
+            "space": space,
+            "M": m,
+            "ef_construction": ef_construction,
+            "ef_search": ef_search,
+            "recall": round(hits / (len(queries) * k), 4),
+            "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies_ms, 95)), 3),
+            "build_seconds": round(build_seconds, 2)
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune HNSW parameters for recall versus latency")
+    parser.add_argument("--persist-directory", default="./chroma_db")
+    parser.add_argument("--spaces", nargs="+", choices=vector_db.DISTANCE_SPACES, default=["cosine"])
+    parser.add_argument("--m", nargs="+", type=int, default=[8, 16, 32])
+    parser.add_argument("--ef-construction", nargs="+", type=int, default=[100, 200])
+    parser.add_argument("--ef-search", nargs="+", type=int, default=[10, 20, 50, 100, 200])
+    parser.add_argument("--k", type=int, default=10, help="Recall@k cut-off")
+    parser.add_argument("--n-queries", type=int, default=200, help="Stored embeddings sampled as queries")
+    parser.add_argument("--queries-file", help="Text file with one query per line (uses the embedder)")
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--threads", type=int, default=4, help="Threads used to build each index")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write all results to this file")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.persist_directory)
+    if len(corpus) == 0:
+        print("The collection is empty; index some images first.")
+        return
+    k = min(args.k, len(corpus))
+    queries = load_queries(args, corpus)
+    print(f"Corpus: {len(corpus)} vectors x {corpus.shape[1]} dims, {len(queries)} queries, recall@{k}")
+
+    results = []
+    for space in args.spaces:
+        truth = exact_top_k(corpus, queries, k, space)
+        for m in args.m:
+            for ef_construction in args.ef_construction:
+                results.extend(evaluate(corpus, queries, truth, k, space, m,
+                                        ef_construction, args.ef_search, args.threads))
+
+    print()
+    print(f"{'space':<7} {'M':>4} {'ef_c':>5} {'ef_s':>5} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'build s':>8}")
+    for r in results:
+        print(f"{r['space']:<7} {r['M']:>4} {r['ef_construction']:>5} {r['ef_search']:>5} "
+              f"{r['recall']:>7.3f} {r['p50_ms']:>8.3f} {r['p95_ms']:>8.3f} {r['build_seconds']:>8.2f}")
+
+    # Fastest setting that reaches the target recall
+    good = [r for r in results if r["recall"] >= args.target_recall]
+    print()
+    if good:
+        best = min(good, key=lambda r: (r["p95_ms"], r["M"]))
+        print(f"Recommended (recall >= {args.target_recall}): space={best['space']}, M={best['M']}, "
+              f"ef_construction={best['ef_construction']}, ef_search={best['ef_search']}")
+        print("Apply to the existing collection with:")
+        print(f"   db.rebuild_index(space='{best['space']}', m={best['M']}, "
+              f"ef_construction={best['ef_construction']}, ef_search={best['ef_search']})")
+        print("and keep it for new collections with:")
+        print(f"   LLAVA_HNSW_SPACE={best['space']} LLAVA_HNSW_M={best['M']} "
+              f"LLAVA_HNSW_EF_CONSTRUCTION={best['ef_construction']} LLAVA_HNSW_EF_SEARCH={best['ef_search']}")
+    else:
+        print(f"No setting reached recall {args.target_recall}; try larger --m or --ef-search values")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"k": k, "corpus_size": len(corpus), "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,47 +3,229 @@ Vector Database for Image-Caption Storage and Search
 Uses ChromaDB for vector storage and sentence-transformers for embeddings
 """
 import chromadb
+import chromadb.errors
 from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
 import os
 from pathlib import Path
 import json
+import threading
+import uuid
 from typing import List, Dict, Optional
 
+from model_manager import IdleEvictingLoader
+import dedupe
+import snapshot
+from lexical_index import BM25Index, reciprocal_rank_fusion
+
+COLLECTION_NAME = "image_captions"
+# Holds the old collection while a rebuilt one is renamed into place
+PREVIOUS_COLLECTION_NAME = f"{COLLECTION_NAME}_previous"
+DISTANCE_SPACES = ("cosine", "l2", "ip")
+SEARCH_MODES = ("vector", "lexical", "hybrid")
+LEXICAL_INDEX_FILE = "lexical_index.jsonl"
+GENERATION_FILE = "generation"
+# Present while a snapshot import runs (see import_snapshot)
+BOOTSTRAP_FILE = "bootstrap.json"
+
+# Reciprocal rank fusion constant, and candidates taken from each ranking per result
+RRF_K = 60
+HYBRID_CANDIDATES = 4
+
+# Rows per add() call when copying a collection
+BATCH_SIZE = 5000
+
+# Raised when a handle's collection was deleted or renamed away (e.g. rebuilt by
+# another process); Chroma < 0.5 has no dedicated class and raises ValueError
+_MISSING_COLLECTION_ERRORS = tuple(
+    getattr(chromadb.errors, name) for name in ("NotFoundError", "InvalidCollectionException")
+    if hasattr(chromadb.errors, name)
+) or (ValueError,)
+
+
+def hnsw_metadata(space: str = "cosine", m: int = 16, ef_construction: int = 100, ef_search: int = 10) -> Dict:
+    """
+    Build collection metadata carrying the HNSW index parameters
+    
+    Args:
+        space: Distance space ('cosine', 'l2' or 'ip')
+        m: Max neighbours per node (higher = better recall, more memory)
+        ef_construction: Candidate list size while building the graph
+        ef_search: Candidate list size while querying (higher = better recall, slower)
+        
+    Returns:
+        Metadata dictionary for ``create_collection``
+    """
+    if space not in DISTANCE_SPACES:
+        raise ValueError(f"Unknown distance space '{space}', expected one of {DISTANCE_SPACES}")
+    return {
+        "description": "Image-caption pairs for semantic search",
+        "hnsw:space": space,
+        "hnsw:M": m,
+        "hnsw:construction_ef": ef_construction,
+        "hnsw:search_ef": ef_search
+    }
+
+
+def doc_id_for(image_path: str) -> str:
+    """Collection ID for an image path (slashes and dots replaced)"""
+    return image_path.replace("/", "_").replace("\\", "_").replace(".", "_")
+
+
+def _process_alive(pid: Optional[int]) -> bool:
+    # Signal 0 only checks for the process on POSIX; on Windows os.kill would terminate it
+    if not pid or os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def distance_to_similarity(distance: float, space: str) -> float:
+    """
+    Convert a Chroma distance to a cosine-style similarity
+    
+    Embeddings from all-MiniLM-L6-v2 are unit-normalized, so every space
+    maps onto cosine similarity.
+    """
+    if space == "l2":
+        # Chroma reports squared L2; for unit vectors ||a - b||^2 = 2 - 2cos
+        return 1 - distance / 2
+    # cosine distance is 1 - cos, ip distance is 1 - dot
+    return 1 - distance
+
+
+class _LiveCollection:
+    """
+    Collection handle that follows COLLECTION_NAME
+    
+    rebuild_index, import_snapshot and clear_all replace the collection, which
+    invalidates handles held by other instances and processes. A call that
+    fails because its collection is gone looks the collection up by name
+    again and is retried once.
+    """
+    
+    def __init__(self, client, collection, on_refresh=None):
+        self._client = client
+        self.target = collection
+        self._on_refresh = on_refresh
+    
+    def __getattr__(self, name):
+        attr = getattr(self.target, name)
+        if not callable(attr):
+            return attr
+        
+        def call(*args, **kwargs):
+            try:
+                return getattr(self.target, name)(*args, **kwargs)
+            except _MISSING_COLLECTION_ERRORS:
+                self.target = self._client.get_collection(COLLECTION_NAME)
+                if self._on_refresh is not None:
+                    self._on_refresh(self.target)
+                return getattr(self.target, name)(*args, **kwargs)
+        return call
+
 
 class ImageCaptionVectorDB:
     """Vector database for storing and searching image-caption pairs"""
     
-    def __init__(self, persist_directory="./chroma_db"):
+    def __init__(self, persist_directory="./chroma_db", distance_space="cosine",
+                 hnsw_m=16, hnsw_ef_construction=100, hnsw_ef_search=10,
+                 chroma_host=None, chroma_port=8000):
         """
         Initialize the vector database
         
+        The HNSW parameters only apply when the collection is created; an
+        existing collection keeps its own (use rebuild_index to change them).
+        Use tune_index.py to pick values for a given corpus.
+        
         Args:
             persist_directory: Directory to persist the database
+            distance_space: Distance space for a new collection ('cosine', 'l2' or 'ip')
+            hnsw_m: HNSW max neighbours per node
+            hnsw_ef_construction: HNSW build-time candidate list size
+            hnsw_ef_search: HNSW query-time candidate list size
+            chroma_host: Chroma server to use instead of an embedded database;
+                required when several processes share the collection
+            chroma_port: Chroma server port
         """
         self.persist_directory = persist_directory
         Path(persist_directory).mkdir(exist_ok=True)
         
-        # Initialize ChromaDB with persistent storage
-        self.client = chromadb.PersistentClient(path=persist_directory)
+        # Rewritten on every write; shared by all processes using this directory (see etag)
+        self.generation_path = os.path.join(persist_directory, GENERATION_FILE)
         
-        # Load embedding model (lightweight but effective)
-        print("Loading embedding model...")
-        self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-        print("Embedding model loaded!")
+        # The embedded client keeps its HNSW index in process memory and is not
+        # multi-process safe, so multi-worker deployments share one Chroma server
+        if chroma_host:
+            self.client = chromadb.HttpClient(host=chroma_host, port=chroma_port)
+        else:
+            self.client = chromadb.PersistentClient(path=persist_directory)
+        
+        # Serves reads from a memory-mapped snapshot while import_snapshot bulk-loads it;
+        # writes made while import_snapshot or rebuild_index copies into a new
+        # collection are recorded and replayed into it before it is swapped in
+        self.snapshot_index = None
+        self._import_lock = threading.Lock()
+        self._pending_writes = None
+        
+        # Other processes sharing persist_directory follow an import through this
+        # marker: they serve reads from the same snapshot and reject writes until it is gone
+        self.bootstrap_path = os.path.join(persist_directory, BOOTSTRAP_FILE)
+        self._bootstrap_lock = threading.Lock()
+        self._bootstrap_key = None
+        self._bootstrap_marker = None
+        self._following_bootstrap = False
         
         # Get or create collection
+        self.index_metadata = hnsw_metadata(distance_space, hnsw_m, hnsw_ef_construction, hnsw_ef_search)
+        self._recover_interrupted_swap()
         try:
-            self.collection = self.client.get_collection("image_captions")
+            self.collection = self.client.get_collection(COLLECTION_NAME)
             print(f"Loaded existing collection with {self.collection.count()} items")
         except:
             self.collection = self.client.create_collection(
-                name="image_captions",
-                metadata={"description": "Image-caption pairs for semantic search"}
+                name=COLLECTION_NAME,
+                metadata=self.index_metadata
             )
             print("Created new collection")
+        
+        # Collections created before the space was configurable use Chroma's default (l2)
+        self.distance_space = (self.collection.metadata or {}).get("hnsw:space", "l2")
+        if self.distance_space != distance_space:
+            print(f"Collection uses '{self.distance_space}' distance; call rebuild_index() to switch to '{distance_space}'")
+        
+        # BM25 index over captions for lexical and hybrid search
+        self.lexical_index = BM25Index(os.path.join(persist_directory, LEXICAL_INDEX_FILE))
+        self.lexical_index.refresh()
+        if self.lexical_index.count() != self.collection.count():
+            self.rebuild_lexical_index(only_if_out_of_sync=True)
     
-    def add_image(self, image_path: str, caption: str, metadata: Optional[Dict] = None):
+    @property
+    def collection(self):
+        """The collection, looked up again by name if it was replaced elsewhere"""
+        return self._collection
+    
+    @collection.setter
+    def collection(self, collection):
+        if getattr(self, "_collection", None) is None:
+            self._collection = _LiveCollection(self.client, collection, on_refresh=self._collection_replaced)
+        else:
+            self._collection.target = collection
+    
+    def _collection_replaced(self, collection):
+        self.distance_space = (collection.metadata or {}).get("hnsw:space", "l2")
+    
+    @property
+    def embedding_model(self):
+        """Embedding model, loaded on first use so listing/stats never import torch"""
+        return get_embedding_model()
+    
+    def add_image(self, image_path: str, caption: str, metadata: Optional[Dict] = None,
+                  embedding: Optional[List[float]] = None):
         """
         Add an image-caption pair to the database
         
@@ -51,9 +233,13 @@ class ImageCaptionVectorDB:
             image_path: Path to the image file (relative to uploads folder)
             caption: Caption/description of the image
             metadata: Optional additional metadata
+            embedding: Precomputed caption embedding (e.g. reused from a near-duplicate)
         """
+        self._check_writable()
+        
         # Generate embedding from caption
-        embedding = self.embedding_model.encode(caption).tolist()
+        if embedding is None:
+            embedding = self.embedding_model.encode(caption).tolist()
         
         # Prepare metadata
         meta = {
@@ -64,29 +250,47 @@ class ImageCaptionVectorDB:
             meta.update(metadata)
         
         # Use image path as unique ID (replace slashes and special chars)
-        doc_id = image_path.replace("/", "_").replace("\\", "_").replace(".", "_")
+        doc_id = doc_id_for(image_path)
         
         # Add to collection
-        self.collection.add(
-            ids=[doc_id],
-            embeddings=[embedding],
-            documents=[caption],
-            metadatas=[meta]
-        )
+        record = dict(ids=[doc_id], embeddings=[embedding], documents=[caption], metadatas=[meta])
+        with self._import_lock:
+            self.collection.add(**record)
+            if self._pending_writes is not None:
+                self._pending_writes.append(("upsert", record))
         
+        self.lexical_index.add(image_path, caption)
+        self._bump_generation()
         print(f"Added image: {image_path}")
     
-    def search(self, query_text: str, n_results: int = 10) -> List[Dict]:
+    def search(self, query_text: str, n_results: int = 10, mode: str = "vector") -> List[Dict]:
         """
         Search for images by text query
         
         Args:
             query_text: Text query to search for
             n_results: Number of results to return
+            mode: 'vector' (embedding similarity), 'lexical' (BM25 over captions,
+                never loads the embedder) or 'hybrid' (reciprocal rank fusion of both)
             
         Returns:
             List of dictionaries containing image_path, caption, and similarity
         """
+        if mode == "vector":
+            return self._vector_search(query_text, n_results)
+        if mode == "lexical":
+            return self._lexical_search(query_text, n_results)
+        if mode == "hybrid":
+            return self._hybrid_search(query_text, n_results)
+        raise ValueError(f"Unknown search mode '{mode}', expected one of {SEARCH_MODES}")
+    
+    def _vector_search(self, query_text: str, n_results: int) -> List[Dict]:
+        self._follow_bootstrap()
+        snapshot_index = self.snapshot_index
+        if snapshot_index is not None:
+            query_embedding = self.embedding_model.encode(query_text)
+            return snapshot_index.search(query_embedding, n_results)
+        
         if self.collection.count() == 0:
             return []
         
@@ -106,12 +310,44 @@ class ImageCaptionVectorDB:
                 formatted_results.append({
                     'image_path': results['metadatas'][0][i]['image_path'],
                     'caption': results['metadatas'][0][i]['caption'],
-                    'similarity': 1 - results['distances'][0][i],  # Convert distance to similarity
+                    'similarity': distance_to_similarity(results['distances'][0][i], self.distance_space),
                     'distance': results['distances'][0][i]
                 })
         
         return formatted_results
     
+    def _lexical_search(self, query_text: str, n_results: int) -> List[Dict]:
+        results = self.lexical_index.search(query_text, n_results)
+        # BM25 scores are unbounded; report similarity relative to the best match
+        best = results[0]['score'] if results else 1.0
+        for result in results:
+            result['similarity'] = result['score'] / best
+        return results
+    
+    def _hybrid_search(self, query_text: str, n_results: int) -> List[Dict]:
+        depth = max(n_results * HYBRID_CANDIDATES, 50)
+        vector_results = self._vector_search(query_text, depth)
+        lexical_results = self.lexical_index.search(query_text, depth)
+        
+        by_path = {r['image_path']: r for r in lexical_results}
+        by_path.update({r['image_path']: r for r in vector_results})
+        vector_ranks = {r['image_path']: rank for rank, r in enumerate(vector_results, start=1)}
+        lexical_ranks = {r['image_path']: rank for rank, r in enumerate(lexical_results, start=1)}
+        
+        fused = reciprocal_rank_fusion(
+            [[r['image_path'] for r in vector_results], [r['image_path'] for r in lexical_results]], k=RRF_K
+        )
+        # Ranked first by both searches scores 1.0
+        best_possible = 2.0 / (RRF_K + 1)
+        return [{
+            'image_path': image_path,
+            'caption': by_path[image_path]['caption'],
+            'similarity': score / best_possible,
+            'rrf_score': score,
+            'vector_rank': vector_ranks.get(image_path),
+            'lexical_rank': lexical_ranks.get(image_path)
+        } for image_path, score in fused[:n_results]]
+    
     def get_all(self) -> List[Dict]:
         """
         Get all image-caption pairs in the database
@@ -119,6 +355,11 @@ class ImageCaptionVectorDB:
         Returns:
             List of dictionaries containing image_path and caption
         """
+        self._follow_bootstrap()
+        snapshot_index = self.snapshot_index
+        if snapshot_index is not None:
+            return snapshot_index.get_all()
+        
         if self.collection.count() == 0:
             return []
         
@@ -136,6 +377,27 @@ class ImageCaptionVectorDB:
         
         return formatted_results
     
+    def get_image(self, image_path: str) -> Optional[Dict]:
+        """
+        Get a stored image-caption pair with its embedding
+        
+        Args:
+            image_path: Path to the image file
+            
+        Returns:
+            Dictionary with image_path, caption, metadata and embedding, or None
+        """
+        results = self.collection.get(ids=[doc_id_for(image_path)], include=["embeddings", "metadatas"])
+        if not results['ids']:
+            return None
+        metadata = results['metadatas'][0]
+        return {
+            'image_path': metadata['image_path'],
+            'caption': metadata['caption'],
+            'metadata': metadata,
+            'embedding': [float(x) for x in results['embeddings'][0]]
+        }
+    
     def delete_image(self, image_path: str):
         """
         Delete an image-caption pair from the database
@@ -143,36 +405,461 @@ class ImageCaptionVectorDB:
         Args:
             image_path: Path to the image file
         """
-        doc_id = image_path.replace("/", "_").replace("\\", "_").replace(".", "_")
+        self._check_writable()
+        doc_id = doc_id_for(image_path)
         try:
-            self.collection.delete(ids=[doc_id])
+            with self._import_lock:
+                self.collection.delete(ids=[doc_id])
+                if self._pending_writes is not None:
+                    self._pending_writes.append(("delete", doc_id))
+            self.lexical_index.remove(image_path)
+            if dedupe.dedupe_enabled():
+                dedupe.get_dedupe_index().remove(image_path)
+            self._bump_generation()
             print(f"Deleted image: {image_path}")
         except Exception as e:
             print(f"Error deleting image {image_path}: {e}")
     
     def clear_all(self):
         """Clear all data from the database"""
+        self._check_writable()
         # Delete and recreate collection
-        self.client.delete_collection("image_captions")
-        self.collection = self.client.create_collection(
-            name="image_captions",
-            metadata={"description": "Image-caption pairs for semantic search"}
-        )
+        with self._import_lock:
+            self.client.delete_collection(COLLECTION_NAME)
+            self.collection = self.client.create_collection(
+                name=COLLECTION_NAME,
+                metadata=self.index_metadata
+            )
+            # A running snapshot import is abandoned rather than swapped in
+            if self._pending_writes is not None:
+                self._pending_writes.append(("clear", None))
+            self.snapshot_index = None
+        self.distance_space = self.index_metadata["hnsw:space"]
+        self.lexical_index.clear()
+        if dedupe.dedupe_enabled():
+            dedupe.get_dedupe_index().clear()
+        self._bump_generation()
         print("Database cleared")
     
+    def rebuild_lexical_index(self, only_if_out_of_sync: bool = False):
+        """
+        Rebuild the BM25 index from the captions stored in the collection
+        
+        Args:
+            only_if_out_of_sync: Skip it if the index already matches the collection
+                size once the log lock is held (e.g. another worker just rebuilt it)
+        """
+        def captions():
+            metadatas = self.collection.get(include=["metadatas"])["metadatas"]
+            return [(m['image_path'], m['caption']) for m in metadatas]
+        
+        expected = self.collection.count() if only_if_out_of_sync else None
+        if self.lexical_index.rebuild(captions, expected_count=expected):
+            print(f"Rebuilt lexical index with {self.lexical_index.count()} captions")
+    
+    def set_ef_search(self, ef_search: int):
+        """
+        Change the query-time HNSW candidate list size
+        
+        Chroma 1.x updates ef_search in place; older versions only take it
+        from the metadata a collection is created with, so the collection is
+        rebuilt.
+        
+        Args:
+            ef_search: Candidate list size while querying
+        """
+        try:
+            self.collection.modify(configuration={"hnsw": {"ef_search": ef_search}})
+        except TypeError:
+            self.rebuild_index(ef_search=ef_search)
+            return
+        self.index_metadata["hnsw:search_ef"] = ef_search
+        self._bump_generation()
+    
+    def rebuild_index(self, space: Optional[str] = None, m: Optional[int] = None,
+                      ef_construction: Optional[int] = None, ef_search: Optional[int] = None):
+        """
+        Copy the collection into a new one with different HNSW parameters
+        
+        Stored embeddings are reused, so nothing is re-encoded. Parameters
+        left as None keep their current values. Images added or deleted during
+        the copy are replayed into the new collection before it takes over;
+        clear_all during the copy abandons the rebuild.
+        """
+        self._check_writable()
+        current = dict(self.collection.metadata or {})
+        metadata = hnsw_metadata(
+            space or current.get("hnsw:space", "l2"),
+            m or current.get("hnsw:M", 16),
+            ef_construction or current.get("hnsw:construction_ef", 100),
+            ef_search or self._current_ef_search()
+        )
+        
+        self._start_recording_writes()
+        try:
+            data = self.collection.get(include=["embeddings", "documents", "metadatas"])
+            temp_name = f"{COLLECTION_NAME}_rebuild"
+            new_collection = self._create_temp_collection(temp_name, metadata)
+            for start in range(0, len(data["ids"]), BATCH_SIZE):
+                end = start + BATCH_SIZE
+                new_collection.add(
+                    ids=data["ids"][start:end],
+                    embeddings=data["embeddings"][start:end],
+                    documents=data["documents"][start:end],
+                    metadatas=data["metadatas"][start:end]
+                )
+            with self._import_lock:
+                writes = self._replay_and_swap_in(new_collection, temp_name)
+                if writes is None:
+                    print("Abandoned index rebuild: the database was cleared during the copy")
+                    return
+                self.index_metadata = metadata
+                self.distance_space = metadata["hnsw:space"]
+        finally:
+            with self._import_lock:
+                self._pending_writes = None
+        self._bump_generation()
+        print(f"Rebuilt index: space={metadata['hnsw:space']}, M={metadata['hnsw:M']}, "
+              f"ef_construction={metadata['hnsw:construction_ef']}, ef_search={metadata['hnsw:search_ef']} "
+              f"(+{len(writes)} writes made during the copy)")
+    
+    def _current_ef_search(self) -> int:
+        # Chroma 1.x keeps the live value in the collection configuration,
+        # older versions in the metadata the collection was created with
+        try:
+            configuration = self.collection.configuration
+        except Exception:
+            configuration = None
+        if isinstance(configuration, dict):
+            hnsw = configuration.get("hnsw") or {}
+            if hnsw.get("ef_search"):
+                return hnsw["ef_search"]
+        metadata = self.collection.metadata or {}
+        return metadata.get("hnsw:search_ef", self.index_metadata["hnsw:search_ef"])
+    
+    def export_snapshot(self, path: str) -> Dict:
+        """
+        Export the collection as a compact snapshot (see snapshot.py)
+        
+        Args:
+            path: Output directory, or a file ending in .tar
+            
+        Returns:
+            The snapshot manifest
+        """
+        data = self.collection.get(include=["embeddings", "documents", "metadatas"])
+        return snapshot.write_snapshot(
+            path, data["ids"], data["embeddings"], data["documents"], data["metadatas"],
+            index_metadata=self.collection.metadata
+        )
+    
+    def import_snapshot(self, path: str, background: bool = True, verify: bool = True) -> int:
+        """
+        Replace the collection with the contents of a snapshot
+        
+        The snapshot's embeddings are memory-mapped and serve search, get_all
+        and count straight away, in this process and in any other using the
+        same persist_directory. The Chroma collection is bulk-loaded in large
+        batches and takes over once the load finishes. Images added or deleted
+        here during the load are replayed into the new collection before it
+        takes over (they show up in vector search only from then on); other
+        processes reject writes until then. clear_all during the load abandons
+        the import. If the load fails, the snapshot stops serving reads and
+        import_status reports the error.
+        
+        Only one process may import into a persist_directory at a time; servers
+        bootstrap through serve.py or get_db() (see LLAVA_BOOTSTRAP_SNAPSHOT).
+        
+        Args:
+            path: Snapshot directory or .tar file
+            background: Bulk-load in a background thread and return immediately
+            verify: Check the snapshot checksums first
+            
+        Returns:
+            Number of items in the snapshot
+        
+        Raises:
+            Exception: Whatever stopped the load, when background is False
+        """
+        self._check_writable()
+        self._start_recording_writes()
+        try:
+            index = snapshot.SnapshotSearchIndex(snapshot.open_snapshot(path, verify))
+        except Exception:
+            with self._import_lock:
+                self._pending_writes = None
+            raise
+        self.snapshot_index = index
+        self.lexical_index.rebuild(lambda: [(m['image_path'], m['caption']) for m in index.metadatas])
+        # Hashes of images outside the snapshot would hand out captions that are no longer indexed
+        if dedupe.dedupe_enabled():
+            dedupe.get_dedupe_index().clear()
+        self._write_bootstrap_marker({"state": "loading", "snapshot": str(index.directory.resolve()), "pid": os.getpid()})
+        self._bump_generation()
+        print(f"Serving {index.count()} items from snapshot {path}")
+        
+        if background:
+            threading.Thread(target=self._bulk_load_snapshot, args=(index,), daemon=True).start()
+        else:
+            self._bulk_load_snapshot(index, raise_errors=True)
+        return index.count()
+    
+    def import_status(self) -> Dict:
+        """
+        State of the latest snapshot import into this persist_directory
+        
+        Returns:
+            {'state': 'idle'}, {'state': 'loading', 'snapshot': path} or
+            {'state': 'failed', 'snapshot': path, 'error': message}
+        """
+        marker = self._read_bootstrap_marker()
+        if marker is None:
+            return {'state': 'idle'}
+        status = {key: marker[key] for key in ('state', 'snapshot', 'error') if key in marker}
+        if status['state'] == 'loading' and not _process_alive(marker.get('pid')):
+            status.update(state='failed', error='The importing process exited before the load finished')
+        return status
+    
+    def _bulk_load_snapshot(self, index, raise_errors: bool = False):
+        swapped = False
+        error = None
+        try:
+            metadata = index.manifest.get("index_metadata") or self.index_metadata
+            temp_name = f"{COLLECTION_NAME}_import"
+            new_collection = self._create_temp_collection(temp_name, metadata)
+            for start in range(0, index.count(), BATCH_SIZE):
+                end = start + BATCH_SIZE
+                new_collection.add(
+                    ids=index.ids[start:end],
+                    embeddings=index.embeddings[start:end].astype("float32").tolist(),
+                    documents=index.documents[start:end],
+                    metadatas=index.metadatas[start:end]
+                )
+            
+            # Writes are blocked from here until the swap, so none can be lost
+            with self._import_lock:
+                writes = self._replay_and_swap_in(new_collection, temp_name)
+                if writes is None:
+                    print("Abandoned snapshot import: the database was cleared during the load")
+                    return
+                self.distance_space = (metadata or {}).get("hnsw:space", "l2")
+                swapped = True
+            print(f"Bulk-loaded {index.count()} snapshot items (+{len(writes)} writes made during the load)")
+        except Exception as e:
+            error = e
+            print(f"Error bulk-loading snapshot: {e}")
+            if raise_errors:
+                raise
+        finally:
+            with self._import_lock:
+                self._pending_writes = None
+                # Writes now go to the old collection, so the snapshot no longer matches it
+                if self.snapshot_index is index:
+                    self.snapshot_index = None
+            if error is not None:
+                self._write_bootstrap_marker({"state": "failed", "snapshot": str(index.directory.resolve()),
+                                              "error": str(error)})
+                self.rebuild_lexical_index()
+            else:
+                self._remove_bootstrap_marker()
+            self._bump_generation()
+    
+    def _follow_bootstrap(self):
+        """Serve reads from a snapshot that another process is importing"""
+        marker = self._read_bootstrap_marker()
+        loading = (marker is not None and marker.get("state") == "loading"
+                   and marker.get("pid") != os.getpid() and _process_alive(marker.get("pid")))
+        if loading == self._following_bootstrap:
+            return
+        with self._bootstrap_lock:
+            if loading and not self._following_bootstrap:
+                # The importer already verified the checksums
+                self.snapshot_index = snapshot.SnapshotSearchIndex(snapshot.open_snapshot(marker["snapshot"], verify=False))
+                self._following_bootstrap = True
+            elif not loading and self._following_bootstrap:
+                self.snapshot_index = None
+                self._following_bootstrap = False
+    
+    def accepts_writes(self) -> bool:
+        """False while another process imports a snapshot into this database"""
+        self._follow_bootstrap()
+        return not self._following_bootstrap
+    
+    def _check_writable(self):
+        if not self.accepts_writes():
+            raise RuntimeError("Another process is importing a snapshot into this database; "
+                               "writes are accepted again once it finishes")
+    
+    def _read_bootstrap_marker(self) -> Optional[Dict]:
+        # Re-read only when the file changes, as this runs on every read
+        try:
+            stat = os.stat(self.bootstrap_path)
+        except FileNotFoundError:
+            self._bootstrap_key = self._bootstrap_marker = None
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key != self._bootstrap_key:
+            try:
+                with open(self.bootstrap_path, encoding="utf-8") as f:
+                    self._bootstrap_marker = json.load(f)
+            except (OSError, ValueError):
+                self._bootstrap_marker = None
+            self._bootstrap_key = key
+        return self._bootstrap_marker
+    
+    def _write_bootstrap_marker(self, marker: Dict):
+        temp_path = f"{self.bootstrap_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(marker, f)
+        os.replace(temp_path, self.bootstrap_path)
+    
+    def _remove_bootstrap_marker(self):
+        try:
+            os.remove(self.bootstrap_path)
+        except FileNotFoundError:
+            pass
+    
+    def _start_recording_writes(self):
+        with self._import_lock:
+            if self._pending_writes is not None:
+                raise RuntimeError("A snapshot import or index rebuild is already running")
+            self._pending_writes = []
+    
+    def _create_temp_collection(self, name: str, metadata: Dict):
+        try:
+            self.client.delete_collection(name)
+        except Exception:
+            pass
+        return self.client.create_collection(name=name, metadata=metadata)
+    
+    def _replay_and_swap_in(self, new_collection, temp_name: str) -> Optional[List]:
+        """
+        Replay the recorded writes into a copied collection and swap it in
+        
+        Called with _import_lock held, so no write can land between the replay
+        and the swap.
+        
+        Returns:
+            The replayed writes, or None if clear_all ran during the copy (the
+            copy is deleted instead)
+        """
+        writes = self._pending_writes
+        if any(op == "clear" for op, _ in writes):
+            self.client.delete_collection(temp_name)
+            return None
+        for op, args in writes:
+            if op == "upsert":
+                new_collection.upsert(**args)
+            else:
+                new_collection.delete(ids=[args])
+        self._swap_in(new_collection)
+        return writes
+    
+    def _swap_in(self, new_collection):
+        """
+        Rename a fully built collection into place
+        
+        The old collection is renamed aside first and only deleted once the new
+        one has its name, so a crash at any point leaves a complete collection
+        that _recover_interrupted_swap restores on the next start.
+        """
+        self.client.get_collection(COLLECTION_NAME).modify(name=PREVIOUS_COLLECTION_NAME)
+        new_collection.modify(name=COLLECTION_NAME)
+        self.collection = new_collection
+        self.client.delete_collection(PREVIOUS_COLLECTION_NAME)
+    
+    def _recover_interrupted_swap(self):
+        # list_collections returns names on Chroma >= 0.6 and Collection objects before
+        names = {getattr(c, "name", c) for c in self.client.list_collections()}
+        if PREVIOUS_COLLECTION_NAME not in names:
+            return
+        if COLLECTION_NAME in names:
+            self.client.delete_collection(PREVIOUS_COLLECTION_NAME)
+        else:
+            self.client.get_collection(PREVIOUS_COLLECTION_NAME).modify(name=COLLECTION_NAME)
+            print("Restored the collection from an interrupted rebuild")
+    
     def count(self) -> int:
         """Get the number of items in the database"""
+        self._follow_bootstrap()
+        snapshot_index = self.snapshot_index
+        if snapshot_index is not None:
+            return snapshot_index.count()
         return self.collection.count()
+    
+    def etag(self) -> str:
+        """
+        Get a version tag that changes whenever the collection is modified
+        
+        Derived from files in persist_directory rather than process memory,
+        so every server worker returns the same tag after any of them writes.
+        """
+        try:
+            with open(self.generation_path, encoding="utf-8") as f:
+                token = f.read().strip()
+        except OSError:
+            token = "0"
+        return f"{token}-{self.count()}"
+    
+    def _bump_generation(self):
+        # A fresh random token (not a counter) so concurrent writers never need a lock
+        temp_path = f"{self.generation_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(uuid.uuid4().hex[:12])
+        os.replace(temp_path, self.generation_path)
+
 
+def _load_embedding_model():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer('all-MiniLM-L6-v2')
 
-# Global database instance
+
+# Global embedding model and database instances. Set LLAVA_EMBEDDER_IDLE_UNLOAD_SECONDS
+# to free the embedder after that many idle seconds.
+_embedding_loader = IdleEvictingLoader(
+    "embedder",
+    _load_embedding_model,
+    idle_seconds=float(os.environ.get("LLAVA_EMBEDDER_IDLE_UNLOAD_SECONDS", "0"))
+)
 _db_instance = None
 
 
+def get_embedding_model():
+    """
+    Get or create the global sentence-transformers embedding model
+    
+    Kept separate from the database so it can be loaded before forking
+    server workers while each worker opens its own ChromaDB client.
+    """
+    return _embedding_loader.get()
+
+
 def get_db():
-    """Get or create the global database instance"""
+    """
+    Get or create the global database instance
+    
+    A new node with an empty collection bootstraps from the snapshot named by
+    LLAVA_BOOTSTRAP_SNAPSHOT, serving reads from it while it bulk-loads.
+    LLAVA_CHROMA_HOST (and LLAVA_CHROMA_PORT) select a Chroma server instead
+    of the embedded database. LLAVA_HNSW_SPACE, LLAVA_HNSW_M,
+    LLAVA_HNSW_EF_CONSTRUCTION and LLAVA_HNSW_EF_SEARCH set the index
+    parameters for a new collection (see tune_index.py).
+    """
     global _db_instance
     if _db_instance is None:
-        _db_instance = ImageCaptionVectorDB()
+        _db_instance = ImageCaptionVectorDB(
+            distance_space=os.environ.get("LLAVA_HNSW_SPACE", "cosine"),
+            hnsw_m=int(os.environ.get("LLAVA_HNSW_M", "16")),
+            hnsw_ef_construction=int(os.environ.get("LLAVA_HNSW_EF_CONSTRUCTION", "100")),
+            hnsw_ef_search=int(os.environ.get("LLAVA_HNSW_EF_SEARCH", "10")),
+            chroma_host=os.environ.get("LLAVA_CHROMA_HOST") or None,
+            chroma_port=int(os.environ.get("LLAVA_CHROMA_PORT", "8000"))
+        )
+        # Read-only replicas never write the index; serve.py imports before forking
+        # workers and removes the variable, so only one process ever imports
+        bootstrap = os.environ.get("LLAVA_BOOTSTRAP_SNAPSHOT")
+        read_only = os.environ.get("LLAVA_SEARCH_ONLY", "0") == "1"
+        if bootstrap and not read_only and _db_instance.collection.count() == 0:
+            _db_instance.import_snapshot(bootstrap)
     return _db_instance
 
@@ -1,7 +1,23 @@
 """
 Quick setup verification script for LLaVA Image Search
 Checks if all components are properly installed and can be imported
+
+With --profile it also benchmarks this machine and writes a performance
+profile: image decode threads, torch threads and the LLaVA dtype (used by
+llava_backend) and the chat KV-cache budget (used by chat_sessions). Caption
+and embedder batch sizes are measured and reported only; app.py logs the
+profile at startup.
 """
+import argparse
+
+parser = argparse.ArgumentParser(description="Verify the setup and optionally profile this machine")
+parser.add_argument("--profile", action="store_true",
+                    help="Benchmark this machine and write a performance profile")
+parser.add_argument("--real-models", action="store_true",
+                    help="Profile with the real LLaVA and embedding models instead of stand-ins")
+parser.add_argument("--output", default=None,
+                    help="Profile path (default: performance_profile.json or $LLAVA_PERF_PROFILE)")
+args = parser.parse_args()
 
 print("=" * 60)
 print("LLaVA Image Search - Setup Verification")
@@ -138,6 +154,208 @@ for dir_name in dirs_to_create:
     print(f"   ✓ {dir_name}/")
 print()
 
+# 11. Performance profile
+if args.profile:
+    print("11. Profiling this machine...")
+    if errors:
+        print("   ✗ Skipped: fix the errors above first")
+    else:
+        import io
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from datetime import datetime
+        
+        import torch
+        from PIL import Image
+        import perf_profile
+        
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        cpu_count = os.cpu_count() or 1
+        
+        def time_call(fn, repeats=3):
+            """Best-of-N wall time of fn() in seconds"""
+            fn()  # warm-up
+            best = float("inf")
+            for _ in range(repeats):
+                start = time.perf_counter()
+                fn()
+                if device == "cuda":
+                    torch.cuda.synchronize()
+                best = min(best, time.perf_counter() - start)
+            return best
+        
+        def pick_smallest_near_best(throughputs, tolerance=0.95):
+            """Smallest setting within tolerance of the best throughput (saves memory/latency)"""
+            best = max(throughputs.values())
+            return min(k for k, v in throughputs.items() if v >= best * tolerance)
+        
+        def candidate_counts(limit):
+            counts = [1]
+            while counts[-1] * 2 <= limit:
+                counts.append(counts[-1] * 2)
+            if counts[-1] != limit:
+                counts.append(limit)
+            return counts
+        
+        measurements = {}
+        settings = {}
+        
+        # Image decode threads: decode a batch of synthetic 1080p JPEGs
+        buf = io.BytesIO()
+        Image.effect_noise((1920, 1080), 64).convert("RGB").save(buf, format="JPEG", quality=90)
+        jpeg = buf.getvalue()
+        
+        def decode_one(_):
+            return Image.open(io.BytesIO(jpeg)).convert("RGB")
+        
+        decode_rates = {}
+        for threads in candidate_counts(min(cpu_count, 16)):
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                seconds = time_call(lambda: list(pool.map(decode_one, range(32))), repeats=2)
+            decode_rates[threads] = 32 / seconds
+        settings["decode_threads"] = pick_smallest_near_best(decode_rates)
+        measurements["decode_images_per_second"] = {str(k): round(v, 1) for k, v in decode_rates.items()}
+        print(f"   ✓ Image decode threads: {settings['decode_threads']}")
+        
+        # torch intra-op threads: a matmul the size of the model's projection layers
+        if device == "cpu":
+            a = torch.randn(512, 896)
+            b = torch.randn(896, 4864)
+            thread_rates = {}
+            for threads in candidate_counts(cpu_count):
+                torch.set_num_threads(threads)
+                thread_rates[threads] = 1 / time_call(lambda: a @ b)
+            settings["torch_threads"] = pick_smallest_near_best(thread_rates)
+            torch.set_num_threads(settings["torch_threads"])
+            measurements["matmul_per_second_by_threads"] = {str(k): round(v, 1) for k, v in thread_rates.items()}
+            print(f"   ✓ torch threads: {settings['torch_threads']}")
+        
+        # Supported dtypes: bf16 matmul and dynamic int8 quantization
+        a = torch.randn(512, 896, device=device)
+        b = torch.randn(896, 4864, device=device)
+        fp32_seconds = time_call(lambda: a @ b)
+        dtype_speedup = {"float32": 1.0}
+        for name, dtype in (("float16", torch.float16), ("bfloat16", torch.bfloat16)):
+            try:
+                a16, b16 = a.to(dtype), b.to(dtype)
+                dtype_speedup[name] = round(fp32_seconds / time_call(lambda: a16 @ b16), 2)
+            except RuntimeError:
+                pass
+        try:
+            linear = torch.nn.Sequential(torch.nn.Linear(896, 4864))
+            quantized = torch.ao.quantization.quantize_dynamic(linear, {torch.nn.Linear}, dtype=torch.qint8)
+            x = torch.randn(512, 896)
+            with torch.inference_mode():
+                int8_seconds = time_call(lambda: quantized(x))
+                fp32_cpu_seconds = time_call(lambda: linear(x))
+            measurements["int8_speedup"] = round(fp32_cpu_seconds / int8_seconds, 2)
+        except (RuntimeError, AttributeError):
+            measurements["int8_speedup"] = None
+        measurements["dtype_speedup"] = dtype_speedup
+        if device == "cuda":
+            settings["llava_dtype"] = "bfloat16" if torch.cuda.is_bf16_supported() else "float16"
+        else:
+            # Half precision on CPU is only worth it with native support (e.g. AVX512-BF16/AMX)
+            settings["llava_dtype"] = "bfloat16" if dtype_speedup.get("bfloat16", 0) > 1.1 else "float32"
+        print(f"   ✓ Dtypes: {dtype_speedup}, int8 speedup: {measurements['int8_speedup']}")
+        print(f"   ✓ LLaVA dtype: {settings['llava_dtype']}")
+        
+        # Vision encoder throughput by batch size. Reported only: captions are generated one
+        # image per request, so there is no batch size to tune yet
+        if args.real_models:
+            import llava_backend
+            backend = llava_backend.get_model()
+            side = backend.image_processor.crop_size["height"] if hasattr(backend.image_processor, "crop_size") else 384
+            
+            def vision_step(batch):
+                images = torch.randn(batch, 3, side, side, dtype=backend.model.dtype, device=backend.model.device)
+                with torch.inference_mode():
+                    backend.model.encode_images(images)
+        else:
+            # Stand-in: ViT-style patch embedding plus transformer layers at SigLIP's width
+            stand_in = torch.nn.Sequential(
+                torch.nn.Conv2d(3, 384, kernel_size=14, stride=14),
+                torch.nn.Flatten(2),
+            ).to(device)
+            layers = torch.nn.TransformerEncoder(
+                torch.nn.TransformerEncoderLayer(384, 6, 1536, batch_first=True), num_layers=2
+            ).to(device).eval()
+            
+            def vision_step(batch):
+                images = torch.randn(batch, 3, 384, 384, device=device)
+                with torch.inference_mode():
+                    layers(stand_in(images).transpose(1, 2))
+        
+        caption_rates = {}
+        for batch in (1, 2, 4, 8):
+            try:
+                caption_rates[batch] = batch / time_call(lambda: vision_step(batch), repeats=2)
+            except RuntimeError:  # Out of memory
+                break
+        if caption_rates:
+            measurements["vision_images_per_second"] = {str(k): round(v, 2) for k, v in caption_rates.items()}
+            print(f"   ✓ Vision encoder: best batch size {pick_smallest_near_best(caption_rates)}")
+        else:
+            warnings.append("Vision encoder benchmark failed (out of memory?)")
+            print("   ⚠ Could not benchmark caption batch sizes")
+        
+        # Embedder throughput by batch size. Reported only: the app embeds one caption
+        # or query at a time, where batch size has no effect
+        captions = ["A detailed description of a photo with several objects in a room. " * 4] * 256
+        if args.real_models:
+            import vector_db
+            embedder = vector_db.get_embedding_model()
+            
+            def embed_step(batch):
+                embedder.encode(captions[:batch * 4], batch_size=batch)
+        else:
+            # Stand-in: MiniLM-sized encoder (6 layers, width 384, 128 tokens)
+            mini = torch.nn.TransformerEncoder(
+                torch.nn.TransformerEncoderLayer(384, 12, 1536, batch_first=True), num_layers=6
+            ).to(device).eval()
+            
+            def embed_step(batch):
+                tokens = torch.randn(batch * 4, 128, 384, device=device)
+                with torch.inference_mode():
+                    for start in range(0, len(tokens), batch):
+                        mini(tokens[start:start + batch])
+        
+        embed_rates = {}
+        for batch in (1, 8, 16, 32, 64):
+            embed_rates[batch] = batch * 4 / time_call(lambda: embed_step(batch), repeats=2)
+        measurements["embeddings_per_second"] = {str(k): round(v, 1) for k, v in embed_rates.items()}
+        print(f"   ✓ Embedder: best batch size {pick_smallest_near_best(embed_rates)}")
+        
+        # KV-cache budget for chat sessions: a quarter of device memory
+        if device == "cuda":
+            total_memory = torch.cuda.get_device_properties(0).total_memory
+        elif hasattr(os, "sysconf") and "SC_PHYS_PAGES" in os.sysconf_names:
+            total_memory = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        else:
+            total_memory = None
+        if total_memory:
+            settings["kv_cache_budget_bytes"] = total_memory // 4
+            print(f"   ✓ Chat KV-cache budget: {total_memory // 4 / 1024 ** 3:.1f}GB")
+        
+        profile = {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "machine": {
+                "device": torch.cuda.get_device_name(0) if device == "cuda" else "cpu",
+                "cpu_count": cpu_count,
+                "total_memory_bytes": total_memory,
+                "torch": torch.__version__,
+                "real_models": args.real_models
+            },
+            "settings": settings,
+            "measurements": measurements
+        }
+        perf_profile.save_profile(profile, args.output)
+        print(f"   ✓ Profile written to {args.output or perf_profile.PROFILE_PATH}")
+        if args.output and os.path.abspath(args.output) != os.path.abspath(perf_profile.PROFILE_PATH):
+            print(f"   ℹ The app reads {perf_profile.PROFILE_PATH}; start it with "
+                  f"LLAVA_PERF_PROFILE={args.output} to use this profile")
+    print()
+
 # Summary
 print("=" * 60)
 print("SUMMARY")